@@ -0,0 +1,163 @@
+"""Async serving mode: the pages of server.py over ASGI
+
+    hypercorn asgi:app
+
+Route handlers are coroutines and talk to the model.py schema through an
+async SQLAlchemy engine (aiosqlite), so a slow client or a database round
+trip never holds a worker. Re-planning, encoding and decoding the weeks of
+a TrainingPlan is CPU work, it runs in PLAN_POOL and the event loop only
+awaits the result.
+"""
+
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+import os
+
+from quart import Quart, render_template, request, session
+from sqlalchemy import select
+from sqlalchemy.ext.asyncio import AsyncSession, create_async_engine
+from sqlalchemy.orm import sessionmaker
+
+import calculator
+import plan_codec
+from model import User, Race, Pace, PlanContext, PLAN_CACHE, apply_sqlite_profile, migrate_db, record_race, week_range
+
+app = Quart(__name__)
+
+#required for Quart session
+app.secret_key = "ABC"
+
+# same file Flask-SQLAlchemy resolves sqlite:///model.db to
+app.config.setdefault("ASYNC_DATABASE_URI",
+                      "sqlite+aiosqlite:///" + os.path.join(app.instance_path, "model.db"))
+# create or migrate the schema when serving starts, see model.connect_to_db
+app.config.setdefault("DB_SETUP", True)
+
+# plan construction, kept off the event loop
+PLAN_POOL = ThreadPoolExecutor(max_workers=4)
+
+engine = None
+Session = None
+
+
+@app.before_serving
+async def connect_to_db():
+    """Open the async engine once per process"""
+
+    global engine, Session
+    engine = create_async_engine(app.config["ASYNC_DATABASE_URI"])
+    # same WAL and pragma settings as connect_to_db, see model.SQLITE_PROFILE
+    apply_sqlite_profile(engine.sync_engine, app.config)
+    if app.config["DB_SETUP"]:
+        os.makedirs(app.instance_path, exist_ok=True)
+        async with engine.begin() as connection:
+            await connection.run_sync(migrate_db)
+    Session = sessionmaker(engine, class_=AsyncSession, expire_on_commit=False)
+
+
+@app.after_serving
+async def close_db():
+    """Dispose of the engine's pooled connections"""
+
+    await engine.dispose()
+
+
+@app.route("/")
+async def index():
+    """Homepage."""
+
+    return await render_template("home.html")
+
+
+@app.route("/calculate-VDOT", methods=["POST"])
+async def create_table():
+    """Store the user and race, then show their pace zones"""
+
+    form = await request.form
+    peak_mileage = float(form.get("mileage"))
+    units = form.get("units")
+    distance = float(form.get("distance"))
+    email = form.get("email")
+    time = float(form.get("minutes")) + (float(form.get("hours")) * 60) + (float(form.get("seconds")) / 60)
+
+    distance_in_meters = calculator.convert_distance_to_meters(distance, units)
+
+    async with Session() as db_session:
+        user_id, race_id, race_VDOT, VDOT = await db_session.run_sync(
+            lambda sync_session: record_race(sync_session.connection(), email, peak_mileage,
+                                             distance_in_meters, time))
+        await store_plan(db_session, user_id)
+        await db_session.commit()
+
+    session["user_id"] = user_id
+    session["VDOT"] = VDOT
+    # paces come straight from the fitness VDOT the insert returned, no re-query
+    easy_list = Pace(session["VDOT"], "easy").convert_timedelta()
+    marathon_list = Pace(session["VDOT"], "marathon").convert_timedelta()
+    tempo_list = Pace(session["VDOT"], "tempo").convert_timedelta()
+
+    return await render_template("generate-calendar.html", VDOT=session["VDOT"],
+                                 easy_low=easy_list[0], marathon_low=marathon_list[0], tempo_low=tempo_list[0],
+                                 easy_high=easy_list[2], marathon_high=marathon_list[2], tempo_high=tempo_list[2])
+
+
+@app.route("/generate-calendar")
+async def create_calendar():
+    """Render weeks of the user's training plan, see server.create_calendar
+
+    the weeks shown are decoded in PLAN_POOL, not on the event loop
+    """
+
+    async with Session() as db_session:
+        data = await db_session.run_sync(plan_codec.stored_data, session["user_id"])
+        if data is None:
+            data = await store_plan(db_session, session["user_id"])
+            await db_session.commit()
+    # only the header is read here, weeks are decoded in PLAN_POOL
+    training_plan = plan_codec.decode(data)
+    try:
+        first, last = week_range(request.args, len(training_plan), training_plan.start_date)
+    except ValueError as error:
+        return str(error), 400
+
+    loop = asyncio.get_running_loop()
+    calendar = await loop.run_in_executor(PLAN_POOL, training_plan.calendar, first, last)
+
+    return await render_template("training-plan.html", training_plan=training_plan[first:last],
+                                 zipped_training_plan=calendar,
+                                 first_week=first + 1, last_week=last, total_weeks=len(training_plan))
+
+
+async def store_plan(db_session, user_id):
+    """Re-plan user_id and store the plan, see server.create_table; return the stored bytes
+
+    replan() and encode() run in PLAN_POOL on a user loaded here, only the
+    upsert goes through the session, uncommitted
+    """
+
+    user = await db_session.get(User, user_id)
+    context = await plan_context(db_session, user)
+    loop = asyncio.get_running_loop()
+    data = await loop.run_in_executor(PLAN_POOL, lambda: plan_codec.encode(user.replan(context=context)))
+    await db_session.run_sync(lambda sync_session: plan_codec.store(sync_session.connection(), user_id, data))
+    return data
+
+
+async def plan_context(db_session, user):
+    """Return PLAN_CACHE.context_for(user), loading the race it may fall back on here"""
+
+    VDOT = user.fitness_vdot
+    if VDOT is None:
+        # see User.fitness_VDOT, the async session can't lazy load the fallback
+        if user.latest_race_id is not None:
+            race = await db_session.get(Race, user.latest_race_id)
+        else:
+            result = await db_session.execute(
+                select(Race).filter(Race.user_id == user.user_id).order_by(Race.race_id.desc()).limit(1))
+            race = result.scalars().first()
+        VDOT = race.VDOT()
+    return PlanContext(round(VDOT, PLAN_CACHE.precision), user.weekly_mileage)
+
+
+if __name__ == "__main__":
+    app.run()
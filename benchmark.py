@@ -0,0 +1,409 @@
+"""Benchmarks for calculator, plan construction and the HTTP endpoints
+
+    python benchmark.py               # run, compare with benchmark-baseline.json
+    python benchmark.py --save        # run and make this run the baseline
+    python benchmark.py -k plan       # only benchmarks with "plan" in the name
+
+Everything runs against a throwaway SQLite database. Each benchmark records
+the best time per call, the peak memory traced during one call, the memory
+blocks still live after that call, and the number of SQL statements one
+call executes. A result regresses when its time or peak memory is more than
+--tolerance over the baseline, when it runs more queries than the baseline
+did, or when it is slower than its budget in BUDGETS, baseline or not.
+Retained blocks are reported, not budgeted. Exits 1 when anything
+regressed, 2 when there is no baseline to compare with.
+"""
+
+import argparse
+import itertools
+import json
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import timeit
+import tracemalloc
+
+from flask import render_template
+from sqlalchemy import event
+
+import calculator
+import plan_codec
+import server
+from model import db, User, Pace, PlanContext, TrainingPlan, PLAN_CACHE
+
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+BASELINE = os.path.join(HERE, "benchmark-baseline.json")
+
+# seconds per call a benchmark may never exceed, whatever the baseline says
+BUDGETS = {
+    # a fresh interpreter importing the app, what every worker and script pays
+    "startup.import_server": 1.0,
+    "startup.create_app": 0.05,
+}
+
+# memory growth under this many bytes is noise, not a regression
+MEMORY_SLACK = 1024
+
+# (name, calls per timing run, setup function), see benchmark()
+BENCHMARKS = []
+
+
+def benchmark(name, number=1000):
+    """Register setup(env) as benchmark name, setup returns the callable to time"""
+
+    def register(setup):
+        BENCHMARKS.append((name, number, setup))
+        return setup
+    return register
+
+
+class Environment(object):
+    """The app on a temp SQLite database, with one athlete already in it"""
+
+    def __init__(self, directory):
+        self.directory = directory
+        self.db_uri = "sqlite:///" + os.path.join(directory, "benchmark.db")
+        self.app = server.create_app({"TESTING": True, "SQLALCHEMY_DATABASE_URI": self.db_uri})
+        self.emails = ("athlete{}@example.com".format(i) for i in itertools.count())
+        self.queries = 0
+        with self.app.app_context():
+            event.listen(db.engine, "before_cursor_execute", self.count_query)
+
+        self.client = self.app.test_client()
+        self.client.post("/calculate-VDOT", data=self.race_form())
+        with self.client.session_transaction() as session:
+            self.user_id = session["user_id"]
+
+    def count_query(self, *args):
+        self.queries += 1
+
+    def close(self):
+        """Close the database and remove the temp directory it was in"""
+
+        with self.app.app_context():
+            db.session.remove()
+            db.engine.dispose()
+        shutil.rmtree(self.directory, ignore_errors=True)
+
+    def race_form(self):
+        """Return a /calculate-VDOT form for a new athlete's 10k in 42:30"""
+
+        return {"email": next(self.emails), "mileage": "50", "units": "kilometers",
+                "distance": "10", "hours": "0", "minutes": "42", "seconds": "30"}
+
+    def user(self):
+        return db.session.get(User, self.user_id)
+
+    def forget_plan(self):
+        """Drop the athlete's cached, rendered and stored plan, without counting the queries"""
+
+        PLAN_CACHE.clear()
+        server.RENDERED_PLANS.clear()
+        queries = self.queries
+        plan_codec.forget(db.session.connection(), [self.user_id])
+        db.session.commit()
+        self.queries = queries
+
+
+################################################################################
+# startup
+
+
+@benchmark("startup.import_server", number=1)
+def import_server(env):
+    command = [sys.executable, "-c", "import server"]
+    return lambda: subprocess.run(command, cwd=HERE, check=True)
+
+
+@benchmark("startup.create_app", number=20)
+def create_app(env):
+    # the schema already exists, the way workers start in production
+    config = {"SQLALCHEMY_DATABASE_URI": env.db_uri, "DB_SETUP": False}
+    return lambda: server.create_app(config)
+
+
+################################################################################
+# calculator
+
+
+@benchmark("calculator.convert_distance_to_meters", number=100000)
+def convert_distance_to_meters(env):
+    return lambda: calculator.convert_distance_to_meters(10, "kilometers")
+
+
+@benchmark("calculator.get_VO2_from_velocity", number=100000)
+def get_VO2_from_velocity(env):
+    return lambda: calculator.get_VO2_from_velocity(303)
+
+
+@benchmark("calculator.get_percent_VO2max", number=100000)
+def get_percent_VO2max(env):
+    return lambda: calculator.get_percent_VO2max(42.5)
+
+
+@benchmark("calculator.user_VDOT", number=100000)
+def user_VDOT(env):
+    return lambda: calculator.user_VDOT(10, "kilometers", 42.5)
+
+
+################################################################################
+# paces and plans
+
+
+@benchmark("pace.pace_range", number=10000)
+def pace_range(env):
+    # a new Pace each call, a Pace caches its velocity
+    return lambda: Pace(48.5, "tempo").pace_range()
+
+
+@benchmark("pace.convert_timedelta", number=10000)
+def convert_timedelta(env):
+    return lambda: Pace(48.5, "tempo").convert_timedelta()
+
+
+@benchmark("plan.context", number=1000)
+def plan_context(env):
+    user = env.user()
+    return lambda: PlanContext.from_user(user)
+
+
+@benchmark("plan.build", number=20)
+def plan_build(env):
+    context = PlanContext.from_user(env.user())
+    return lambda: TrainingPlan(context, build=True)
+
+
+@benchmark("plan.cached", number=10000)
+def plan_cached(env):
+    user = env.user()
+    return lambda: user.training_plan()
+
+
+@benchmark("plan.encode", number=200)
+def plan_encode(env):
+    training_plan = TrainingPlan(PlanContext.from_user(env.user()), build=True)
+    return lambda: plan_codec.encode(training_plan)
+
+
+@benchmark("plan.decode", number=200)
+def plan_decode(env):
+    data = plan_codec.encode(TrainingPlan(PlanContext.from_user(env.user()), build=True))
+    return lambda: plan_codec.decode(data).weeks
+
+
+@benchmark("plan.decode_page", number=1000)
+def plan_decode_page(env):
+    # the two weeks /generate-calendar shows by default
+    data = plan_codec.encode(TrainingPlan(PlanContext.from_user(env.user()), build=True))
+    return lambda: plan_codec.decode(data)[0:2]
+
+
+@benchmark("plan.stored", number=1000)
+def plan_stored(env):
+    # the single-row read /generate-calendar starts with
+    return lambda: plan_codec.plan_data(db.session, env.user_id)
+
+
+@benchmark("render.training_plan", number=20)
+def render_training_plan(env):
+    training_plan = TrainingPlan(PlanContext.from_user(env.user()), build=True)
+
+    def render():
+        with env.app.test_request_context():
+            return render_template("training-plan.html", training_plan=training_plan.weeks,
+                                   zipped_training_plan=training_plan.calendar(),
+                                   first_week=1, last_week=len(training_plan),
+                                   total_weeks=len(training_plan))
+    return render
+
+
+################################################################################
+# HTTP, through the Flask test client
+
+
+@benchmark("http.calculate_VDOT", number=50)
+def http_calculate_VDOT(env):
+    # its own client, so env.client stays logged in as the first athlete
+    client = env.app.test_client()
+    return lambda: client.post("/calculate-VDOT", data=env.race_form())
+
+
+@benchmark("http.generate_calendar", number=50)
+def http_generate_calendar(env):
+    def cold():
+        env.forget_plan()
+        return env.client.get("/generate-calendar")
+    return cold
+
+
+@benchmark("http.generate_calendar_all", number=20)
+def http_generate_calendar_all(env):
+    def cold():
+        env.forget_plan()
+        return env.client.get("/generate-calendar?weeks=all")
+    return cold
+
+
+@benchmark("http.generate_calendar_cached", number=200)
+def http_generate_calendar_cached(env):
+    return lambda: env.client.get("/generate-calendar")
+
+
+################################################################################
+# Running and comparing
+
+
+def measure(env, call, number, repeat=5):
+    """Return dict of seconds per call, peak_bytes, retained_blocks and queries for call
+
+    retained_blocks counts the memory blocks one call allocated that were
+    still live when it returned, its result included, from a tracemalloc
+    snapshot diff; blocks allocated and freed during the call aren't in it
+    """
+
+    # warm caches and lazy imports, so one call below is a steady state call
+    call()
+
+    env.queries = 0
+    call()
+    queries = env.queries
+
+    tracemalloc.start()
+    before = tracemalloc.take_snapshot()
+    # the snapshot itself is traced, count from after it
+    traced = tracemalloc.get_traced_memory()[0]
+    tracemalloc.reset_peak()
+    result = call()
+    peak_bytes = tracemalloc.get_traced_memory()[1] - traced
+    after = tracemalloc.take_snapshot()
+    tracemalloc.stop()
+    del result
+    retained_blocks = sum(stat.count_diff for stat in after.compare_to(before, "lineno") if stat.count_diff > 0)
+
+    seconds = min(timeit.repeat(call, repeat=repeat, number=number)) / number
+    return {"seconds": seconds, "peak_bytes": peak_bytes, "retained_blocks": retained_blocks,
+            "queries": queries, "number": number}
+
+
+def run(pattern=None, out=sys.stdout):
+    """Run the benchmarks whose name contains pattern, return dict of results by name"""
+
+    results = {}
+    directory = tempfile.mkdtemp(prefix="benchmark-")
+    env = Environment(directory)
+    try:
+        with env.app.app_context():
+            for name, number, setup in BENCHMARKS:
+                if pattern and pattern not in name:
+                    continue
+                results[name] = measure(env, setup(env), number)
+                out.write(format_result(name, results[name]) + "\n")
+                out.flush()
+    finally:
+        env.close()
+    return results
+
+
+def format_result(name, result):
+    return "{:<36} {:>12.1f} us {:>10.1f} KiB {:>7} retained {:>4} queries".format(
+        name, result["seconds"] * 1e6, result["peak_bytes"] / 1024.0, result.get("retained_blocks", "-"),
+        result["queries"])
+
+
+def regressions(results, baseline, tolerance=0.25):
+    """Return a line for each result worse than its baseline
+
+    >>> regressions({"a": {"seconds": 1.3, "peak_bytes": 4000, "retained_blocks": 80, "queries": 2}},
+    ...             {"a": {"seconds": 1.0, "peak_bytes": 2000, "retained_blocks": 40, "queries": 1}})
+    ['a: seconds 1.3 > 1 (+30%)', 'a: peak_bytes 4e+03 > 2e+03 (+100%)', 'a: queries 2 > 1']
+    >>> regressions({"a": {"seconds": 1.0, "peak_bytes": 100, "queries": 1}},
+    ...             {"a": {"seconds": 1.0, "queries": 1}})
+    []
+    >>> regressions({"new": {"seconds": 9, "peak_bytes": 0, "queries": 0}}, {})
+    []
+    >>> regressions({"startup.create_app": {"seconds": 0.2, "peak_bytes": 0, "queries": 0}}, {})
+    ['startup.create_app: seconds 0.2 over budget 0.05']
+
+    """
+    lines = []
+    for name, result in sorted(results.items()):
+        budget = BUDGETS.get(name)
+        if budget is not None and result["seconds"] > budget:
+            lines.append("{}: seconds {:.3g} over budget {:.3g}".format(name, result["seconds"], budget))
+        base = baseline.get(name)
+        if base is None:
+            continue
+        for field in ("seconds", "peak_bytes"):
+            # baselines saved before a field was measured don't hold it
+            if field not in base:
+                continue
+            limit = base[field] * (1 + tolerance)
+            if field == "peak_bytes":
+                limit = max(limit, base[field] + MEMORY_SLACK)
+            if result[field] > limit:
+                growth = " (+{:.0%})".format(result[field] / base[field] - 1) if base[field] else ""
+                lines.append("{}: {} {:.3g} > {:.3g}{}".format(name, field, result[field], base[field], growth))
+        if result["queries"] > base["queries"]:
+            lines.append("{}: queries {} > {}".format(name, result["queries"], base["queries"]))
+    return lines
+
+
+def load_baseline(path):
+    """Return the benchmarks dict of the baseline file at path, {} if there isn't one"""
+
+    if not os.path.exists(path):
+        return {}
+    with open(path) as baseline_file:
+        return json.load(baseline_file)["benchmarks"]
+
+
+def save_baseline(path, results):
+    """Write results to path, merged over any baseline already there"""
+
+    benchmarks = load_baseline(path)
+    benchmarks.update(results)
+    baseline = {
+        "created": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "python": platform.python_version(),
+        "machine": platform.machine(),
+        "benchmarks": benchmarks,
+    }
+    with open(path, "w") as baseline_file:
+        json.dump(baseline, baseline_file, indent=2, sort_keys=True)
+        baseline_file.write("\n")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("-k", dest="pattern", help="only benchmarks whose name contains this")
+    parser.add_argument("--baseline", default=BASELINE, help="baseline json, default %(default)s")
+    parser.add_argument("--save", action="store_true", help="write this run to the baseline")
+    parser.add_argument("--tolerance", type=float, default=0.25,
+                        help="allowed slowdown or memory growth, default %(default)s")
+    args = parser.parse_args(argv)
+
+    results = run(args.pattern)
+    if args.save:
+        save_baseline(args.baseline, results)
+        print("saved {} benchmarks to {}".format(len(results), args.baseline))
+        return 0
+
+    baseline = load_baseline(args.baseline)
+    if not baseline:
+        print("no baseline at {}, run with --save to make one".format(args.baseline), file=sys.stderr)
+        return 2
+    lines = regressions(results, baseline, args.tolerance)
+    for line in lines:
+        print("REGRESSION " + line)
+    print("{} regressions in {} benchmarks".format(len(lines), len(results)))
+    return 1 if lines else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
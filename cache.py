@@ -0,0 +1,122 @@
+"""Bounded in-process caches"""
+
+from collections import OrderedDict
+import threading
+
+
+class LRUCache(object):
+    """Mapping of at most maxsize entries, evicting the least recently used
+
+    Counts hits, misses and evictions so the cache can be tuned. Safe to
+    share between threads.
+
+    >>> lru = LRUCache(maxsize=2)
+    >>> lru.put("a", 1)
+    >>> lru.put("b", 2)
+    >>> lru.get("a")
+    1
+    >>> lru.put("c", 3)
+    >>> "b" in lru
+    False
+    >>> lru.stats()
+    {'size': 2, 'maxsize': 2, 'hits': 1, 'misses': 0, 'evictions': 1}
+
+    """
+
+    def __init__(self, maxsize=128):
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        """Return cached value for key, or default, and count the hit/miss"""
+
+        with self._lock:
+            if key in self._entries:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return self._entries[key]
+            self.misses += 1
+            return default
+
+    def put(self, key, value):
+        """Store value for key, evicting the oldest entries when full"""
+
+        with self._lock:
+            self._entries[key] = value
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def get_or_build(self, key, build):
+        """Return cached value for key, calling build() to fill a miss
+
+        build runs outside the lock, two threads missing on the same key at
+        once may both build, the last one stored wins.
+        """
+
+        missing = object()
+        value = self.get(key, missing)
+        if value is missing:
+            value = build()
+            self.put(key, value)
+        return value
+
+    def get_or_build_many(self, keys, build, executor=None):
+        """Return dict of key to value, calling build(key) once per distinct miss
+
+        misses are built with executor.map() when an executor is given, so
+        build must then be picklable for a process pool
+        """
+
+        absent = object()
+        values = {}
+        missing = []
+        for key in set(keys):
+            value = self.get(key, absent)
+            if value is absent:
+                missing.append(key)
+            else:
+                values[key] = value
+        if executor is None:
+            built = map(build, missing)
+        else:
+            built = executor.map(build, missing, chunksize=max(1, len(missing) // 64))
+        for key, value in zip(missing, built):
+            self.put(key, value)
+            values[key] = value
+        return values
+
+    def resize(self, maxsize):
+        """Change maxsize, evicting down to it if needed"""
+
+        with self._lock:
+            self.maxsize = maxsize
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def clear(self):
+        """Drop every entry, counters are kept"""
+
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self):
+        """Return dict of size, maxsize, hits, misses and evictions"""
+
+        with self._lock:
+            return {"size": len(self._entries), "maxsize": self.maxsize,
+                    "hits": self.hits, "misses": self.misses, "evictions": self.evictions}
+
+    def __contains__(self, key):
+        with self._lock:
+            return key in self._entries
+
+    def __len__(self):
+        with self._lock:
+            return len(self._entries)
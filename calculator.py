@@ -1,7 +1,49 @@
 
 import math
+import numpy as np
 
 
+# the units convert_distance_to_meters() knows, anything else is taken as meters
+UNITS = ("meters", "kilometers", "miles")
+
+# the VDOTs a runner can have, pace_table's 30-85 grid with room either side;
+# far outside it the formulas give nonsense paces, or overflow
+VDOT_LIMITS = (20.0, 100.0)
+
+
+def plausible_VDOT(VDOT):
+    """Return whether VDOT is a number within VDOT_LIMITS
+
+    >>> plausible_VDOT(48.5), plausible_VDOT(857933), plausible_VDOT(float("nan"))
+    (True, False, False)
+
+    """
+    return VDOT_LIMITS[0] <= VDOT <= VDOT_LIMITS[1]
+
+
+def check_race(distance, units, time, weekly_mileage):
+    """Raise ValueError unless a race and weekly mileage can be scored and planned
+
+    units must be one of UNITS; distance, time and weekly_mileage finite
+    and positive
+
+    >>> check_race(10, "kilometers", 42.5, 50)
+    >>> check_race(float("nan"), "kilometers", 45, 50)
+    Traceback (most recent call last):
+    ...
+    ValueError: distance must be a positive number
+    >>> check_race(10, "furlongs", 45, 50)
+    Traceback (most recent call last):
+    ...
+    ValueError: unknown units 'furlongs'
+
+    """
+    if units not in UNITS:
+        raise ValueError("unknown units {!r}".format(units))
+    for name, value in (("distance", distance), ("time", time), ("weekly_mileage", weekly_mileage)):
+        if not (math.isfinite(value) and value > 0):
+            raise ValueError("{} must be a positive number".format(name))
+
 def convert_distance_to_meters(distance, units):
     """Return distance in meters
 
@@ -86,6 +128,39 @@ def seconds_to_minutes(seconds):
     # return minutes
 
 
+def hms_to_minutes(hms):
+    """Return minutes given a "h:m:s" (or "m:s") time string
+
+    >>> hms_to_minutes("1:05:15")
+    65.25
+
+    >>> hms_to_minutes("17:30")
+    17.5
+
+    """
+    parts = [float(part) for part in hms.split(":")]
+    if len(parts) > 3:
+        raise ValueError("time must be h:m:s, got {!r}".format(hms))
+    while len(parts) < 3:
+        parts.insert(0, 0.0)
+    hours, minutes, seconds = parts
+    return hours_to_minutes(hours) + minutes + seconds_to_minutes(seconds)
+
+
+def minutes_to_hms(minutes):
+    """Return "h:mm:ss" given minutes, rounded to the second
+
+    >>> minutes_to_hms(65.25)
+    '1:05:15'
+
+    >>> minutes_to_hms(17.5)
+    '0:17:30'
+
+    """
+    seconds = int(round(minutes * 60))
+    return "{}:{:02d}:{:02d}".format(seconds // 3600, seconds // 60 % 60, seconds % 60)
+
+
 def velocity(distance, time):
     """Return velocity
 
@@ -184,6 +259,214 @@ def user_VDOT(distance, units, time):
     return VDOT
 
 
+################################################################################
+# Array variants
+#
+# Same formulas as above, over NumPy arrays (or any sequence) so many races
+# can be scored in one call. Scalars broadcast against arrays.
+
+
+def convert_distance_to_meters_array(distances, units):
+    """Return array of distances in meters
+
+    units may be one string for every distance, or one per distance
+
+    >>> convert_distance_to_meters_array([5, 1, 10000], ["kilometers", "miles", "meters"])
+    array([ 5000.  ,  1609.34, 10000.  ])
+
+    >>> convert_distance_to_meters_array([5, 10], "kilometers")
+    array([ 5000., 10000.])
+
+    """
+    distances = np.asarray(distances, dtype=float)
+    units = np.asarray(units)
+    factors = np.select([units == "kilometers", units == "miles"], [1000.0, 1609.34], 1.0)
+    meters = distances * factors
+    return meters
+
+
+def velocity_array(distances, times):
+    """Return array of velocities
+
+    a time of 0 gives inf (nan for a distance of 0 too) rather than
+    raising, so one bad row can't sink a batch
+
+    >>> velocity_array([1000, 1000, 0], [5, 0, 0])
+    array([200.,  inf,  nan])
+
+    """
+    with np.errstate(divide="ignore", invalid="ignore"):
+        velocity = np.asarray(distances, dtype=float) / np.asarray(times, dtype=float)
+    return velocity
+
+
+def get_velocity_from_VO2_array(VO2):
+    """Return array of velocities given VO2
+
+    >>> get_velocity_from_VO2_array([60])
+    array([302.41418])
+
+    """
+    VO2 = np.asarray(VO2, dtype=float)
+    vel = 29.54 + 5.000663 * VO2 - 0.007546 * VO2**2
+    return vel
+
+
+def get_VO2_from_velocity_array(velocity):
+    """Return array of VO2 given velocities
+
+    >>> get_VO2_from_velocity_array([303])
+    array([60.17231])
+
+    """
+    velocity = np.asarray(velocity, dtype=float)
+    VO2 = -4.60 + 0.182258 * velocity + 0.000104 * velocity**2
+    return VO2
+
+
+def get_percent_VO2max_array(times):
+    """Returns array of percentages of VO2max
+
+    >>> get_percent_VO2max_array([9]).tolist() == [get_percent_VO2max(9)]
+    True
+
+    """
+    times = np.asarray(times, dtype=float)
+    exponent1 = np.exp(-0.012778 * times)
+    exponent2 = np.exp(-0.1932605 * times)
+    percent_VO2max = 0.8 + 0.1894393 * exponent1 + 0.2989558 * exponent2
+    return percent_VO2max
+
+
+def user_VDOT_array(distances, units, times):
+    """Returns array of VDOTs, one per race
+
+    >>> user_VDOT_array([10, 5000, 2], ["kilometers", "meters", "miles"], [35, 17, 10.5])
+    array([60.73272857, 60.19040538, 60.74163962])
+
+    matches user_VDOT race for race
+    >>> user_VDOT_array([10], "kilometers", [35]).tolist() == [user_VDOT(10, "kilometers", 35)]
+    True
+
+    """
+    percent_VO2 = get_percent_VO2max_array(times)
+    meters = convert_distance_to_meters_array(distances, units)
+    vel = velocity_array(meters, times)
+    race_VO2 = get_VO2_from_velocity_array(vel)
+
+    VDOT = race_VO2 / percent_VO2
+    return VDOT
+
+
+################################################################################
+# Race equivalence
+#
+# The inverse of user_VDOT: the race time a VDOT predicts over a distance.
+# There is no closed form, so race_time_array solves
+#
+#     get_VO2_from_velocity(distance / t) / get_percent_VO2max(t) = VDOT
+#
+# for t with Newton's method, kept inside a bracket that always holds the
+# root: a step that would leave the bracket bisects it instead.
+
+
+# (name, meters) for equivalent performance tables
+RACE_DISTANCES = (
+    ("1500m", 1500.0),
+    ("mile", 1609.34),
+    ("5K", 5000.0),
+    ("10K", 10000.0),
+    ("15K", 15000.0),
+    ("half marathon", 21097.5),
+    ("marathon", 42195.0),
+)
+
+
+def race_time_array(VDOTs, distances, units="meters", tol=1e-6, max_iter=50):
+    """Return array of race times in minutes, one per VDOT and distance
+
+    VDOTs and distances broadcast against each other, so VDOTs[:, None]
+    against a row of distances gives a table, one row per athlete. Stops
+    when every time has moved less than tol minutes in an iteration. A VDOT
+    outside what 50 to 2000 m/min would score over the distance gives nan.
+
+    >>> race_time_array([50], [5000, 42195]).round(4)
+    array([ 19.9337, 190.6624])
+
+    >>> race_time_array([3], [5000])
+    array([nan])
+
+    round trips through user_VDOT_array
+    >>> times = race_time_array([[30], [50], [85]], [1500, 10000, 42195])
+    >>> bool(np.allclose(user_VDOT_array([1500, 10000, 42195], "meters", times), [[30], [50], [85]]))
+    True
+
+    """
+    VDOTs = np.asarray(VDOTs, dtype=float)
+    meters = convert_distance_to_meters_array(distances, units)
+    VDOTs, meters = np.broadcast_arrays(VDOTs, meters)
+
+    # 2000 m/min to 50 m/min, far past a world record down to a walk
+    low = meters / 2000.0
+    high = meters / 50.0
+    solvable = (_VDOT_error(meters, low, VDOTs)[0] >= 0) & (_VDOT_error(meters, high, VDOTs)[0] <= 0)
+    # first guess, the pace of running at 90% of VDOT
+    times = np.clip(meters / get_velocity_from_VO2_array(0.9 * VDOTs), low, high)
+    for i in range(max_iter):
+        error, slope = _VDOT_error(meters, times, VDOTs)
+        # VDOT falls as the time grows, so a positive error means too fast
+        low = np.where(error > 0, times, low)
+        high = np.where(error > 0, high, times)
+        with np.errstate(divide="ignore", invalid="ignore"):
+            newton = times - error / slope
+        # times is now one end of the bracket, so the ends count as inside
+        outside = ~((newton >= low) & (newton <= high))
+        new_times = np.where(outside, (low + high) / 2, newton)
+        step = np.abs(new_times - times)
+        times = new_times
+        if np.all(step < tol):
+            break
+    return np.where(solvable, times, np.nan)
+
+
+def _VDOT_error(meters, times, VDOTs):
+    """Return the VDOT of running meters in times, less VDOTs, and its derivative in time"""
+
+    velocity = meters / times
+    VO2 = get_VO2_from_velocity_array(velocity)
+    percent = get_percent_VO2max_array(times)
+    dVO2 = (0.182258 + 0.000208 * velocity) * -velocity / times
+    dpercent = (-0.012778 * 0.1894393 * np.exp(-0.012778 * times)
+                - 0.1932605 * 0.2989558 * np.exp(-0.1932605 * times))
+    error = VO2 / percent - VDOTs
+    slope = (dVO2 * percent - VO2 * dpercent) / percent**2
+    return error, slope
+
+
+def race_time(VDOT, distance, units="meters"):
+    """Return the race time in minutes VDOT predicts over distance
+
+    >>> minutes_to_hms(race_time(50, 10, "kilometers"))
+    '0:41:20'
+
+    """
+    return float(race_time_array(VDOT, distance, units))
+
+
+def equivalent_times(VDOTs, distances=None):
+    """Return array of race times in minutes, a row per VDOT and a column per distance (meters)
+
+    distances defaults to the meters of RACE_DISTANCES
+
+    >>> equivalent_times([40, 60]).shape
+    (2, 7)
+
+    """
+    if distances is None:
+        distances = [meters for name, meters in RACE_DISTANCES]
+    VDOTs = np.asarray(VDOTs, dtype=float).reshape(-1, 1)
+    return race_time_array(VDOTs, np.asarray(distances, dtype=float).reshape(1, -1))
+
 # examples of how to use datetime.timedelta
 # >>> hr = 1
 # >>> mm = 60
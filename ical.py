@@ -0,0 +1,93 @@
+"""iCalendar (RFC 5545) export of training plans
+
+One all-day VEVENT per workout day, rest days are left out. Everything is
+a generator of text chunks so a calendar can be streamed to the client, a
+whole roster of plans as easily as one.
+"""
+
+from datetime import timedelta
+import hashlib
+import time
+
+
+PRODID = "-//FastAsYouCan//Training Plan//EN"
+
+
+def iter_calendar(entries, name="Training Plan"):
+    """Yield an iCalendar document for entries, one chunk per event
+
+    entries is an iterable of (athlete, TrainingPlan), athlete being any
+    string that tells the plans apart (an email for instance). Weeks are
+    taken from TrainingPlan.iter_weeks(), so plans built lazily are built
+    one week at a time as the calendar is written.
+    """
+
+    stamp = time.strftime("%Y%m%dT%H%M%SZ", time.gmtime())
+    yield "".join(fold(line) for line in (
+        "BEGIN:VCALENDAR",
+        "VERSION:2.0",
+        "PRODID:" + PRODID,
+        "CALSCALE:GREGORIAN",
+        "X-WR-CALNAME:" + escape(name),
+    ))
+    for athlete, training_plan in entries:
+        uid_prefix = hashlib.sha1(athlete.encode("utf-8")).hexdigest()[:16]
+        for i, week in enumerate(training_plan.iter_weeks()):
+            for day, workout in zip(training_plan.week_days(i), week.workouts):
+                if workout.segments:
+                    yield event(day, workout, uid_prefix, stamp)
+    yield fold("END:VCALENDAR")
+
+
+def event(day, workout, uid_prefix, stamp):
+    """Return VEVENT text for a Workout on day"""
+
+    details = []
+    for segment in workout.segments:
+        details.append("".join(segment.show_segment()).strip())
+    return "".join(fold(line) for line in (
+        "BEGIN:VEVENT",
+        "UID:{}-{}@fastasyoucan".format(uid_prefix, day.strftime("%Y%m%d")),
+        "DTSTAMP:" + stamp,
+        "DTSTART;VALUE=DATE:" + day.strftime("%Y%m%d"),
+        "DTEND;VALUE=DATE:" + (day + timedelta(days=1)).strftime("%Y%m%d"),
+        "SUMMARY:" + escape(workout.show_workout()),
+        "DESCRIPTION:" + escape("\n".join(details)),
+        "TRANSP:TRANSPARENT",
+        "END:VEVENT",
+    ))
+
+
+def escape(text):
+    r"""Return text escaped for an iCalendar TEXT value
+
+    >>> print(escape("Reps: 2 x 10 min; Rest, 1 min\nDone"))
+    Reps: 2 x 10 min\; Rest\, 1 min\nDone
+
+    """
+    return (text.replace("\\", "\\\\").replace(";", "\\;")
+            .replace(",", "\\,").replace("\n", "\\n"))
+
+
+def fold(line):
+    r"""Return line with CRLF, folded to 75 octet lines as RFC 5545 asks
+
+    >>> fold("SUMMARY:" + "x" * 70).split("\r\n")
+    ['SUMMARY:xxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxx', ' xxx', '']
+
+    """
+    encoded = line.encode("utf-8")
+    if len(encoded) <= 75:
+        return line + "\r\n"
+    parts = []
+    limit = 75
+    while encoded:
+        cut = min(limit, len(encoded))
+        # never split a multi-byte character
+        while cut < len(encoded) and (encoded[cut] & 0xC0) == 0x80:
+            cut -= 1
+        parts.append(encoded[:cut].decode("utf-8"))
+        encoded = encoded[cut:]
+        # continuation lines start with a space, which counts toward the 75
+        limit = 74
+    return "\r\n ".join(parts) + "\r\n"
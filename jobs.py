@@ -0,0 +1,287 @@
+"""Background jobs, queued in the jobs table and run by a local pool of worker threads
+
+    job_id = jobs.enqueue(db.session.connection(), "plan", user_id)
+    db.session.commit()
+    queue.wake()
+    ...
+    jobs.status(db.session, job_id)     # or queue.wait(job_id, 10) to long-poll
+
+The queue is the jobs table in the app's own SQLite database, there is no
+broker: a job is a row, a worker claims the oldest queued row with one
+UPDATE ... RETURNING, runs its handler and records the result in the same
+transaction as the handler's writes. Queued jobs survive a restart and
+every process's workers share them, a row is only ever claimed once.
+
+Workers in the process that enqueued a job start on it as soon as wake() is
+called; jobs enqueued elsewhere are picked up within poll seconds. A job
+still running lease seconds after it was claimed is taken to have lost its
+worker and is queued again, up to MAX_ATTEMPTS times.
+"""
+
+import json
+import threading
+import time
+
+from sqlalchemy import select
+
+import plan_codec
+from model import db, Job, User
+
+
+# a job that fails this many claims is marked failed instead of requeued
+MAX_ATTEMPTS = 3
+
+FINISHED = ("done", "failed")
+
+
+def plan_job(session, user_id):
+    """Re-plan and store user_id's training plan, see User.replan(), return a summary"""
+
+    user = session.get(User, user_id)
+    if user is None:
+        raise LookupError("no user {}".format(user_id))
+    training_plan = user.replan()
+    data = plan_codec.save(session.connection(), user_id, training_plan)
+    return {"start_date": training_plan.start_date.isoformat(), "weeks": len(training_plan),
+            "bytes": len(data)}
+
+
+# kind -> handler(session, user_id), returning something json serializable
+HANDLERS = {
+    "plan": plan_job,
+}
+
+
+def enqueue(connection, kind, user_id=None):
+    """Queue a job on connection and return its job_id, no commit
+
+    when the same kind of job is already queued for user_id that job's id is
+    returned instead, it hasn't started and will see the same data
+    """
+
+    if kind not in HANDLERS:
+        raise ValueError("unknown job kind {!r}".format(kind))
+    jobs = Job.__table__
+    if user_id is not None:
+        queued = connection.execute(
+            select(jobs.c.job_id)
+            .where(jobs.c.user_id == user_id, jobs.c.kind == kind, jobs.c.status == "queued")
+            .limit(1)).scalar()
+        if queued is not None:
+            return queued
+    return connection.execute(jobs.insert().values(
+        kind=kind, user_id=user_id, status="queued", attempts=0, created_at=time.time())).inserted_primary_key[0]
+
+
+def status(connection, job_id):
+    """Return dict of job_id's row, result decoded, None if there is no such job"""
+
+    row = connection.execute(select(Job.__table__).where(Job.__table__.c.job_id == job_id)).first()
+    if row is None:
+        return None
+    job = dict(row._mapping)
+    if job["result"] is not None:
+        job["result"] = json.loads(job["result"])
+    return job
+
+
+def recent_failure(connection, kind, user_id, since):
+    """Return status() of user_id's latest failed job of kind if it failed after since, else None"""
+
+    jobs = Job.__table__
+    job_id = connection.execute(
+        select(jobs.c.job_id)
+        .where(jobs.c.user_id == user_id, jobs.c.kind == kind, jobs.c.status == "failed",
+               jobs.c.finished_at > since)
+        .order_by(jobs.c.job_id.desc()).limit(1)).scalar()
+    return None if job_id is None else status(connection, job_id)
+
+
+class JobQueue(object):
+    """A pool of worker threads running the app's queued jobs
+
+    Threads start on start() (or the first wake()), each job runs in an app
+    context with db.session. close() stops the threads once they finish
+    the job they are on.
+
+    What a worker thread does, one step at a time: claim a job and run it
+
+    >>> import server
+    >>> from model import record_race
+    >>> app = server.create_app({"SQLALCHEMY_DATABASE_URI": "sqlite:///:memory:"})
+    >>> queue = JobQueue(app, lease=0)
+    >>> with app.app_context():
+    ...     user_id = record_race(db.session.connection(), "a@example.com", 50, 10000, 42.5)[0]
+    ...     job_id = enqueue(db.session.connection(), "plan", user_id)
+    ...     enqueue(db.session.connection(), "plan", user_id) == job_id
+    ...     db.session.commit()
+    True
+    >>> queue.execute(*queue.claim())
+    >>> with app.app_context():
+    ...     job = status(db.session, job_id)
+    >>> job["status"], job["attempts"], job["result"]["weeks"]
+    ('done', 1, 18)
+
+    a job whose worker is lost is queued again once its lease is up, until
+    it has been claimed MAX_ATTEMPTS times
+
+    >>> with app.app_context():
+    ...     lost_id = enqueue(db.session.connection(), "plan", user_id)
+    ...     db.session.commit()
+    >>> claims = []
+    >>> for attempt in range(MAX_ATTEMPTS):
+    ...     claims.append(queue.claim()[0])
+    ...     queue.maintain()
+    >>> claims == [lost_id] * MAX_ATTEMPTS, queue.claim()
+    (True, None)
+    >>> with app.app_context():
+    ...     job = status(db.session, lost_id)
+    >>> job["status"], job["attempts"], job["error"]
+    ('failed', 3, 'worker lost 3 times')
+
+    a handler that raises fails its job with the error
+
+    >>> with app.app_context():
+    ...     missing_id = enqueue(db.session.connection(), "plan", user_id + 1)
+    ...     db.session.commit()
+    >>> queue.execute(*queue.claim())
+    >>> with app.app_context():
+    ...     status(db.session, missing_id)["error"]
+    'LookupError: no user 2'
+    """
+
+    def __init__(self, app, workers=2, poll=1.0, lease=300, retention=86400):
+        self.app = app
+        self.workers = workers
+        self.poll = poll
+        self.lease = lease
+        self.retention = retention
+        with app.app_context():
+            self.engine = db.engine
+        self.threads = []
+        self.lock = threading.Lock()
+        # set by wake(), a queued job may be waiting
+        self.pending = threading.Event()
+        self.stopping = threading.Event()
+        # notified, and finished_count bumped, each time a job here finishes
+        self.finished = threading.Condition()
+        self.finished_count = 0
+        self.maintained = 0
+        self.maintain_lock = threading.Lock()
+
+    def start(self):
+        with self.lock:
+            if self.threads:
+                return
+            self.stopping.clear()
+            for i in range(self.workers):
+                thread = threading.Thread(target=self.run, name="job-worker-{}".format(i), daemon=True)
+                thread.start()
+                self.threads.append(thread)
+
+    def wake(self):
+        """Tell the workers a job was just committed, starting them if need be"""
+
+        self.start()
+        self.pending.set()
+
+    def close(self):
+        """Stop the workers, waiting for the jobs they are running"""
+
+        with self.lock:
+            self.stopping.set()
+            self.pending.set()
+            for thread in self.threads:
+                thread.join()
+            self.threads = []
+
+    def join(self):
+        """Block until close() is called from another thread"""
+
+        self.stopping.wait()
+
+    def run(self):
+        while not self.stopping.is_set():
+            # cleared before claiming, so a wake() after an empty claim isn't missed
+            self.pending.clear()
+            try:
+                job = self.claim()
+                if job is not None:
+                    self.execute(*job)
+                elif not self.pending.wait(self.poll):
+                    self.maintain()
+            except Exception:
+                # the database is busy or gone; a job claimed here is requeued after its lease
+                self.app.logger.exception("job worker")
+                self.stopping.wait(self.poll)
+
+    def claim(self):
+        """Mark the oldest queued job running and return (job_id, kind, user_id), None if there is none"""
+
+        jobs = Job.__table__
+        oldest = (select(jobs.c.job_id).where(jobs.c.status == "queued")
+                  .order_by(jobs.c.job_id).limit(1).scalar_subquery())
+        with self.engine.begin() as connection:
+            return connection.execute(
+                jobs.update()
+                .where(jobs.c.job_id == oldest, jobs.c.status == "queued")
+                .values(status="running", started_at=time.time(), attempts=jobs.c.attempts + 1)
+                .returning(jobs.c.job_id, jobs.c.kind, jobs.c.user_id)).first()
+
+    def execute(self, job_id, kind, user_id):
+        """Run a claimed job, recording its result in the handler's transaction"""
+
+        jobs = Job.__table__
+        with self.app.app_context():
+            try:
+                result = HANDLERS[kind](db.session, user_id)
+                db.session.execute(jobs.update().where(jobs.c.job_id == job_id).values(
+                    status="done", result=json.dumps(result), finished_at=time.time()))
+                db.session.commit()
+            except Exception as error:
+                db.session.rollback()
+                db.session.execute(jobs.update().where(jobs.c.job_id == job_id).values(
+                    status="failed", error="{}: {}".format(type(error).__name__, error),
+                    finished_at=time.time()))
+                db.session.commit()
+        with self.finished:
+            self.finished_count += 1
+            self.finished.notify_all()
+
+    def maintain(self):
+        """Requeue jobs whose worker was lost and delete old finished jobs, at most every lease seconds"""
+
+        now = time.time()
+        with self.maintain_lock:
+            if now - self.maintained < self.lease:
+                return
+            self.maintained = now
+        jobs = Job.__table__
+        stale = (jobs.c.status == "running") & (jobs.c.started_at < now - self.lease)
+        with self.engine.begin() as connection:
+            connection.execute(jobs.update().where(stale, jobs.c.attempts < MAX_ATTEMPTS)
+                               .values(status="queued"))
+            connection.execute(jobs.update().where(stale).values(
+                status="failed", error="worker lost {} times".format(MAX_ATTEMPTS), finished_at=now))
+            connection.execute(jobs.delete().where(jobs.c.status.in_(FINISHED),
+                                                   jobs.c.finished_at < now - self.retention))
+
+    def wait(self, job_id, timeout):
+        """Return status(job_id) once the job has finished, or as it is after timeout seconds
+
+        wakes as soon as a worker here finishes a job, and every poll seconds
+        for jobs run by other processes
+        """
+
+        deadline = time.monotonic() + timeout
+        while True:
+            with self.finished:
+                seen = self.finished_count
+            # a connection per look, so each read sees the latest commit
+            with self.engine.connect() as connection:
+                job = status(connection, job_id)
+            remaining = deadline - time.monotonic()
+            if job is None or job["status"] in FINISHED or remaining <= 0:
+                return job
+            with self.finished:
+                self.finished.wait_for(lambda: self.finished_count != seen, min(remaining, self.poll))
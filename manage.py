@@ -0,0 +1,269 @@
+"""Command line maintenance tasks
+
+    python manage.py import-races results.csv
+    python manage.py import-races results.jsonl --batch-size 5000
+    python manage.py backfill-vdot
+    python manage.py init-db
+    python manage.py run-jobs --workers 4
+"""
+
+import argparse
+import csv
+import json
+import sys
+import time
+
+from sqlalchemy import bindparam
+
+import calculator
+import plan_codec
+from jobs import JobQueue
+from model import db, init_db, fitness_update, User, Race, refresh_latest_races
+from server import create_app
+
+
+IMPORT_FIELDS = ("email", "weekly_mileage", "distance", "units", "time")
+
+
+################################################################################
+# import-races
+
+
+def iter_records(path, file_format=None):
+    """Yield (line number, record dict or None, error) for each record in path"""
+
+    if file_format is None:
+        file_format = "jsonl" if path.endswith((".jsonl", ".json")) else "csv"
+    with open(path, newline="") as import_file:
+        if file_format == "csv":
+            reader = csv.DictReader(import_file)
+            for row in reader:
+                yield (reader.line_num,) + parse_record(row)
+        else:
+            for line_num, line in enumerate(import_file, 1):
+                if not line.strip():
+                    continue
+                try:
+                    row = json.loads(line)
+                except ValueError as error:
+                    yield line_num, None, "bad json: {}".format(error)
+                    continue
+                yield (line_num,) + parse_record(row)
+
+
+def parse_record(row):
+    """Return (record, None) for a valid row or (None, reason) for a rejected one"""
+
+    try:
+        missing = [field for field in IMPORT_FIELDS if row.get(field) in (None, "")]
+        if missing:
+            return None, "missing {}".format(", ".join(missing))
+        record = {
+            "email": row["email"].strip(),
+            "weekly_mileage": float(row["weekly_mileage"]),
+            "distance": float(row["distance"]),
+            "units": row["units"].strip().lower(),
+            "time": calculator.hms_to_minutes(str(row["time"])),
+        }
+        calculator.check_race(record["distance"], record["units"], record["time"], record["weekly_mileage"])
+    except (ValueError, TypeError, AttributeError) as error:
+        return None, str(error)
+    return record, None
+
+
+def insert_batch(records):
+    """Insert users and races for a batch of records in one transaction
+
+    Users are matched on email: new emails are inserted, known ones get
+    their weekly_mileage updated (the last record in the batch wins). Each
+    race is folded into its user's fitness_vdot, and the stored plans of
+    the users touched are deleted, to be rebuilt when next viewed. All
+    statements are executemany, so a batch costs a handful of round trips.
+    """
+
+    users = {}
+    for record in records:
+        users[record["email"]] = record["weekly_mileage"]
+
+    user_ids = lookup_user_ids(users)
+    new_users = [{"email": email, "weekly_mileage": mileage}
+                 for email, mileage in users.items() if email not in user_ids]
+    known_users = [{"b_user_id": user_ids[email], "b_weekly_mileage": mileage}
+                   for email, mileage in users.items() if email in user_ids]
+    if new_users:
+        db.session.execute(User.__table__.insert(), new_users)
+        user_ids.update(lookup_user_ids([user["email"] for user in new_users]))
+    if known_users:
+        users_table = User.__table__
+        db.session.execute(
+            users_table.update()
+            .where(users_table.c.user_id == bindparam("b_user_id"))
+            .values(weekly_mileage=bindparam("b_weekly_mileage")),
+            known_users)
+
+    meters = calculator.convert_distance_to_meters_array(
+        [record["distance"] for record in records], [record["units"] for record in records])
+    times = [record["time"] for record in records]
+    VDOTs = calculator.user_VDOT_array(meters, "meters", times)
+    races = [{"user_id": user_ids[record["email"]], "distance": float(distance), "time": race_time,
+              "vdot": float(VDOT)}
+             for record, distance, race_time, VDOT in zip(records, meters, times, VDOTs)]
+    db.session.execute(Race.__table__.insert(), races)
+    # core inserts skip the ORM event that keeps latest_race_id and fitness_vdot current
+    refresh_latest_races(set(user_ids[email] for email in users))
+    users_table = User.__table__
+    # one O(1) update per race, in insert order, as race_added() would have done
+    db.session.execute(
+        users_table.update()
+        .where(users_table.c.user_id == bindparam("b_user_id"))
+        .values(fitness_vdot=fitness_update(bindparam("b_vdot"))),
+        [{"b_user_id": race["user_id"], "b_vdot": race["vdot"]} for race in races])
+    plan_codec.forget(db.session.connection(), sorted(set(user_ids[email] for email in users)))
+    db.session.commit()
+
+
+def lookup_user_ids(emails):
+    """Return dict of email to user_id for the emails already in users"""
+
+    emails = list(emails)
+    user_ids = {}
+    # stay under SQLite's bound parameter limit
+    for i in range(0, len(emails), 500):
+        chunk = emails[i:i + 500]
+        query = db.session.query(User.email, User.user_id).filter(User.email.in_(chunk))
+        user_ids.update(dict(query.all()))
+    return user_ids
+
+
+def import_races(path, file_format=None, batch_size=1000, out=sys.stdout):
+    """Stream path into users and races in batches, return (imported, rejected)"""
+
+    imported = 0
+    rejected = 0
+    started = time.time()
+    batch = []
+    for line_num, record, error in iter_records(path, file_format):
+        if record is None:
+            rejected += 1
+            out.write("rejected line {}: {}\n".format(line_num, error))
+            continue
+        batch.append(record)
+        if len(batch) >= batch_size:
+            insert_batch(batch)
+            imported += len(batch)
+            batch = []
+            elapsed = time.time() - started
+            out.write("{} rows, {:.0f} rows/s\n".format(imported, imported / elapsed))
+    if batch:
+        insert_batch(batch)
+        imported += len(batch)
+
+    elapsed = time.time() - started
+    out.write("imported {} rows, rejected {} rows in {:.2f}s ({:.0f} rows/s)\n".format(
+        imported, rejected, elapsed, imported / elapsed if elapsed else 0))
+    return imported, rejected
+
+
+################################################################################
+# backfill-vdot
+
+
+def backfill_vdot(chunk_size=5000, out=sys.stdout):
+    """Store VDOT on every race that doesn't have it, chunk_size rows per transaction
+
+    Walks races in race_id order so each chunk is one indexed range read,
+    scores the chunk with calculator.user_VDOT_array and writes it back with
+    one executemany update. Returns the number of rows filled.
+    """
+
+    races = Race.__table__
+    update = (races.update()
+              .where(races.c.race_id == bindparam("b_race_id"))
+              .values(vdot=bindparam("b_vdot")))
+    filled = 0
+    last_id = 0
+    started = time.time()
+    while True:
+        rows = db.session.execute(
+            db.select(races.c.race_id, races.c.distance, races.c.time)
+            .where(races.c.vdot.is_(None))
+            .where(races.c.race_id > last_id)
+            .order_by(races.c.race_id)
+            .limit(chunk_size)).fetchall()
+        if not rows:
+            break
+        race_ids, distances, times = zip(*rows)
+        VDOTs = calculator.user_VDOT_array(distances, "meters", times)
+        db.session.execute(update, [{"b_race_id": race_id, "b_vdot": float(VDOT)}
+                                    for race_id, VDOT in zip(race_ids, VDOTs)])
+        db.session.commit()
+        filled += len(rows)
+        last_id = race_ids[-1]
+        out.write("{} rows, {:.0f} rows/s\n".format(filled, filled / (time.time() - started)))
+
+    out.write("filled vdot on {} races in {:.2f}s\n".format(filled, time.time() - started))
+    return filled
+
+
+################################################################################
+# run-jobs
+
+
+def run_jobs(app, workers):
+    """Run queued jobs until interrupted, for servers that leave them to a separate process"""
+
+    queue = JobQueue(app, workers=workers, poll=app.config["JOB_POLL_SECONDS"],
+                     lease=app.config["JOB_LEASE_SECONDS"], retention=app.config["JOB_RETENTION_SECONDS"])
+    queue.start()
+    print("running jobs with {} workers".format(workers))
+    try:
+        queue.join()
+    except KeyboardInterrupt:
+        print("finishing running jobs")
+        queue.close()
+
+
+################################################################################
+# Command line
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    commands = parser.add_subparsers(dest="command")
+    commands.required = True
+
+    import_parser = commands.add_parser("import-races", help="bulk import race results")
+    import_parser.add_argument("path", help="csv or jsonl of {}".format(", ".join(IMPORT_FIELDS)))
+    import_parser.add_argument("--format", choices=("csv", "jsonl"), default=None,
+                               help="defaults to the file extension")
+    import_parser.add_argument("--batch-size", type=int, default=1000)
+
+    backfill_parser = commands.add_parser("backfill-vdot", help="store VDOT on races missing it")
+    backfill_parser.add_argument("--chunk-size", type=int, default=5000)
+
+    commands.add_parser("init-db", help="create or migrate the database schema")
+
+    jobs_parser = commands.add_parser("run-jobs", help="run queued background jobs")
+    jobs_parser.add_argument("--workers", type=int, default=None, help="defaults to JOB_WORKERS")
+
+    args = parser.parse_args(argv)
+    # init-db is the only command that sets up the schema, and does it below
+    app = create_app({"DB_SETUP": False} if args.command == "init-db" else None)
+    with app.app_context():
+        if args.command == "init-db":
+            init_db()
+            print("database at {} is up to date".format(app.config["SQLALCHEMY_DATABASE_URI"]))
+            return 0
+        if args.command == "import-races":
+            imported, rejected = import_races(args.path, args.format, args.batch_size)
+            return 1 if rejected and not imported else 0
+        if args.command == "backfill-vdot":
+            backfill_vdot(args.chunk_size)
+            return 0
+        if args.command == "run-jobs":
+            run_jobs(app, args.workers or app.config["JOB_WORKERS"])
+            return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
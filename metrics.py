@@ -0,0 +1,242 @@
+"""Per-route request metrics, served at /metrics in Prometheus text format
+
+    metrics.init_app(app)
+    metrics.register_cache("plans", PLAN_CACHE)
+
+Records, labelled by route (the url rule, not the path, so labels stay few):
+
+- request latency histograms and request counts by status
+- SQL statement counts and time, from SQLAlchemy cursor events on every engine
+- template render time, from Flask's template signals
+- plan week build time, reported by model.TrainingPlan
+- hits, misses, evictions and size of registered caches, read at scrape time
+
+Recording is a few dict updates under a lock per event, cheap enough to
+leave on in production. Streamed responses are timed until the view
+returns, not until the last chunk is sent.
+"""
+
+import bisect
+import threading
+import time
+
+from flask import g, has_request_context, request, template_rendered, before_render_template
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+
+# Prometheus client defaults, in seconds
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+class Counter(object):
+    """A count for each set of label values"""
+
+    kind = "counter"
+
+    def __init__(self, name, help, labels=()):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self.values = {}
+        self.lock = threading.Lock()
+
+    def inc(self, label_values=(), amount=1):
+        with self.lock:
+            self.values[label_values] = self.values.get(label_values, 0) + amount
+
+    def samples(self):
+        """Yield (name, label pairs, value) for the exposition"""
+
+        with self.lock:
+            values = sorted(self.values.items())
+        for label_values, value in values:
+            yield self.name, list(zip(self.labels, label_values)), value
+
+
+class Histogram(object):
+    """Observations bucketed by upper bound, with their sum and count, for each set of label values"""
+
+    kind = "histogram"
+
+    def __init__(self, name, help, labels=(), buckets=BUCKETS):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self.buckets = buckets
+        # label values -> [count per bucket (not cumulative) + overflow, sum]
+        self.values = {}
+        self.lock = threading.Lock()
+
+    def observe(self, label_values, value):
+        i = bisect.bisect_left(self.buckets, value)
+        with self.lock:
+            counts = self.values.get(label_values)
+            if counts is None:
+                counts = self.values[label_values] = [0] * (len(self.buckets) + 1) + [0.0]
+            counts[i] += 1
+            counts[-1] += value
+
+    def samples(self):
+        with self.lock:
+            values = sorted((label_values, list(counts)) for label_values, counts in self.values.items())
+        for label_values, counts in values:
+            labels = list(zip(self.labels, label_values))
+            total = 0
+            for bound, count in zip(self.buckets + ("+Inf",), counts):
+                total += count
+                yield self.name + "_bucket", labels + [("le", str(bound))], total
+            yield self.name + "_sum", labels, counts[-1]
+            yield self.name + "_count", labels, total
+
+
+REQUESTS = Counter("fayc_requests_total", "HTTP requests", ("route", "method", "status"))
+REQUEST_SECONDS = Histogram("fayc_request_duration_seconds", "Time spent in the view", ("route", "method"))
+SQL_STATEMENTS = Counter("fayc_sql_statements_total", "SQL statements executed", ("route",))
+SQL_SECONDS = Counter("fayc_sql_seconds_total", "Time spent executing SQL statements", ("route",))
+TEMPLATE_SECONDS = Histogram("fayc_template_render_seconds", "Time spent rendering templates",
+                             ("route", "template"))
+PLAN_WEEK_SECONDS = Histogram("fayc_plan_week_build_seconds", "Time spent building one plan week",
+                              ("route",), buckets=(0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005,
+                                                   0.01, 0.025, 0.05, 0.1))
+
+METRICS = [REQUESTS, REQUEST_SECONDS, SQL_STATEMENTS, SQL_SECONDS, TEMPLATE_SECONDS, PLAN_WEEK_SECONDS]
+
+# name -> LRUCache-like object with stats(), see register_cache()
+CACHES = {}
+
+
+def current_route():
+    """Return the url rule of the request being handled, "none" outside one"""
+
+    if not has_request_context():
+        return "none"
+    if request.url_rule is None:
+        return "unmatched"
+    return request.url_rule.rule
+
+
+def observe_plan_week(seconds):
+    """Record building one week of a TrainingPlan"""
+
+    PLAN_WEEK_SECONDS.observe((current_route(),), seconds)
+
+
+def register_cache(name, cache):
+    """Report cache.stats() at /metrics under cache="name" """
+
+    CACHES[name] = cache
+
+
+################################################################################
+# Event hooks
+
+
+def start_request():
+    g.metrics_started = time.perf_counter()
+
+
+def finish_request(response):
+    started = g.pop("metrics_started", None)
+    if started is not None:
+        record_request(time.perf_counter() - started, response.status_code)
+    return response
+
+
+def fail_request(error):
+    # after_request never ran, the view raised
+    started = g.pop("metrics_started", None)
+    if started is not None:
+        record_request(time.perf_counter() - started, 500)
+
+
+def record_request(seconds, status):
+    route = current_route()
+    REQUEST_SECONDS.observe((route, request.method), seconds)
+    REQUESTS.inc((route, request.method, str(status)))
+
+
+def start_template(app, template, context, **extra):
+    g.setdefault("metrics_templates", []).append(time.perf_counter())
+
+
+def finish_template(app, template, context, **extra):
+    started = g.get("metrics_templates")
+    if started:
+        TEMPLATE_SECONDS.observe((current_route(), template.name or "string"),
+                                 time.perf_counter() - started.pop())
+
+
+@event.listens_for(Engine, "before_cursor_execute")
+def start_statement(conn, cursor, statement, parameters, context, executemany):
+    conn.info.setdefault("metrics_started", []).append(time.perf_counter())
+
+
+@event.listens_for(Engine, "after_cursor_execute")
+def finish_statement(conn, cursor, statement, parameters, context, executemany):
+    started = conn.info.get("metrics_started")
+    if started:
+        route = (current_route(),)
+        SQL_SECONDS.inc(route, time.perf_counter() - started.pop())
+        SQL_STATEMENTS.inc(route)
+
+
+################################################################################
+# Exposition
+
+
+def escape(value):
+    r"""Return value escaped for a label
+
+    >>> print(escape('say "hi"'))
+    say \"hi\"
+
+    """
+    return value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def format_sample(name, labels, value):
+    """Return one exposition line
+
+    >>> format_sample("x_total", [("route", "/")], 3)
+    'x_total{route="/"} 3'
+
+    """
+    if labels:
+        name += "{" + ",".join('{}="{}"'.format(key, escape(val)) for key, val in labels) + "}"
+    return "{} {}".format(name, repr(float(value)) if isinstance(value, float) else value)
+
+
+def render():
+    """Return every metric and registered cache in Prometheus text format"""
+
+    lines = []
+    for metric in METRICS:
+        lines.append("# HELP {} {}".format(metric.name, metric.help))
+        lines.append("# TYPE {} {}".format(metric.name, metric.kind))
+        lines.extend(format_sample(*sample) for sample in metric.samples())
+
+    stats = sorted((name, cache.stats()) for name, cache in CACHES.items())
+    for field, kind in (("hits", "counter"), ("misses", "counter"), ("evictions", "counter"),
+                        ("size", "gauge"), ("maxsize", "gauge")):
+        name = "fayc_cache_{}".format(field) + ("_total" if kind == "counter" else "")
+        lines.append("# HELP {} Cache {}".format(name, field))
+        lines.append("# TYPE {} {}".format(name, kind))
+        lines.extend(format_sample(name, [("cache", cache_name)], cache_stats[field])
+                     for cache_name, cache_stats in stats)
+    return "\n".join(lines) + "\n"
+
+
+def metrics_view():
+    return render(), 200, {"Content-Type": "text/plain; version=0.0.4; charset=utf-8"}
+
+
+def init_app(app):
+    """Record app's requests and templates and serve them at /metrics"""
+
+    app.before_request(start_request)
+    app.after_request(finish_request)
+    app.teardown_request(fail_request)
+    before_render_template.connect(start_template, app)
+    template_rendered.connect(finish_template, app)
+    app.add_url_rule("/metrics", "metrics", metrics_view)
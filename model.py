@@ -1,11 +1,22 @@
-from flask import Flask
 from flask_sqlalchemy import SQLAlchemy
+from sqlalchemy import bindparam, case, event, inspect, text
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+import cache
 import calculator
+import metrics
+import pace_table
+from collections import namedtuple
+from itertools import groupby
+from concurrent.futures import Future
 from datetime import timedelta, date
+import glob
+import json
+import os
+import queue
+import threading
+import time
 
 
-app = Flask(__name__)
-
 DB_URI = "sqlite:///model.db"
 
 db = SQLAlchemy()
@@ -23,6 +34,15 @@ class User(db.Model):
     email = db.Column(db.String(50), unique=True)
     weekly_mileage = db.Column(db.Integer, nullable=True)
     # TODO(kara): if time change units on weekly_mileage
+    # race_id of the user's most recent race, kept up to date on insert.
+    # no ForeignKey, races already points at users and SQLite can't add the cycle
+    latest_race_id = db.Column(db.Integer, nullable=True)
+    # recency weighted VDOT over every race, see fitness_VDOT()
+    fitness_vdot = db.Column(db.Float, nullable=True)
+    # the Monday the user's plan started, and json [[from_week, VDOT, weekly_mileage], ...]
+    # revisions of it, see replan(); a user without them follows next Monday's plan
+    plan_start = db.Column(db.Date, nullable=True)
+    plan_history = db.Column(db.Text, nullable=True)
 
     def greet(self):
         """Greet using email"""
@@ -31,21 +51,72 @@ class User(db.Model):
     def paces(self, intensity):
         """Return object of Pace class"""
 
-        # finds users most recent race
-        most_recent_race = Race.query.filter(Race.user_id == self.user_id).order_by(Race.race_id.desc()).first()
         # __init__ on Pace looks like: Pace(self, VDOT, intensity(as string))
-        VDOT = most_recent_race.VDOT()
+        VDOT = self.fitness_VDOT()
         pace_obj = Pace(VDOT, intensity)
         return pace_obj
 
+    def fitness_VDOT(self):
+        """Return VDOT weighted over the user's whole race history, recent races counting most
+
+        stored on the row and updated in O(1) as each race is inserted, see
+        race_added(); rows from before the column fall back to the most
+        recent race
+        """
+        if self.fitness_vdot is not None:
+            return self.fitness_vdot
+        return self.most_recent_race().VDOT()
+
     def most_recent_race(self):
-        """Return most recent Race object for a user"""
+        """Return most recent Race object for a user
+
+        a primary key lookup through latest_race_id, falling back to the
+        (user_id, race_id) index for rows the pointer hasn't reached
+        """
+        if self.latest_race_id is not None:
+            return db.session.get(Race, self.latest_race_id)
         race = Race.query.filter(Race.user_id == self.user_id).order_by(Race.race_id.desc()).first()
         return race
 
     def training_plan(self):
-        """Return TrainingPlan based on user's most recent race"""
-        return TrainingPlan(self)
+        """Return TrainingPlan based on user's fitness VDOT, or on the revisions replan() stored
+
+        plans are shared through PLAN_CACHE, treat the result as read-only
+        """
+        return PLAN_CACHE.plan_for(self)
+
+    def replan(self, today=None, context=None):
+        """Re-plan from the coming week with the user's fitness VDOT and weekly mileage
+
+        Weeks that have started keep what they were planned with and the
+        calendar keeps its start date; the weeks after are rescaled, see
+        TrainingPlan.replan(). The first call, or one after the plan has
+        ended, starts a plan next Monday. Sets plan_start and plan_history
+        without committing, returns the new plan. Pass context when the
+        caller already has one from PLAN_CACHE.context_for(); replan() then
+        makes no queries.
+        """
+        today = today or date.today()
+        context = context or PLAN_CACHE.context_for(self)
+        revision = [context.VDOT, context.weekly_mileage]
+        revisions = json.loads(self.plan_history) if self.plan_history else []
+        total_weeks = len(PLAN_TEMPLATES[DEFAULT_PLAN].weeks)
+        from_week = 0
+        if self.plan_start is not None:
+            # the plan starts on a Monday, the week today falls in has started
+            from_week = max(0, (today - self.plan_start).days // 7 + 1)
+        if not revisions or from_week >= total_weeks:
+            self.plan_start = next_monday(today)
+            self.plan_history = json.dumps([[0] + revision])
+            return self.training_plan()
+        if revisions[-1][1:] == revision:
+            return self.training_plan()
+
+        training_plan = self.training_plan()
+        revisions = [kept for kept in revisions if kept[0] < from_week] + [[from_week] + revision]
+        self.plan_history = json.dumps(revisions)
+        return PLAN_CACHE.get_or_build(PLAN_CACHE.key_for(self),
+                                       lambda: training_plan.replan(context, from_week))
 
     def __repr__(self):
         """Provide helpful representation when printed"""
@@ -65,11 +136,26 @@ class Race(db.Model):
     distance = db.Column(db.Integer, nullable=False)
     # time in minutes
     time = db.Column(db.Integer, nullable=False)
+    # stored at insert by set_race_VDOT(), manage.py backfill-vdot fills older rows
+    vdot = db.Column(db.Float, nullable=True)
 
     user = db.relationship("User", backref=db.backref("races", order_by=race_id))
 
+    __table_args__ = (
+        # most_recent_race() filters on user_id and sorts on race_id
+        db.Index("ix_races_user_id_race_id", "user_id", "race_id"),
+        db.Index("ix_races_vdot", "vdot"),
+    )
+
     def VDOT(self):
-        """Return user VDOT"""
+        """Return user VDOT, as stored on the row when it was inserted"""
+
+        if self.vdot is not None:
+            return self.vdot
+        return self.calculate_VDOT()
+
+    def calculate_VDOT(self):
+        """Return user VDOT computed from distance and time"""
 
         percent_VO2 = calculator.get_percent_VO2max(self.time)
         vel = calculator.velocity(self.distance, self.time)
@@ -86,6 +172,115 @@ class Race(db.Model):
         return string.format(self.race_id, self.user_id, self.distance, self.time)
 
 
+class StoredPlan(db.Model):
+    """A user's current TrainingPlan, encoded by plan_codec"""
+
+    __tablename__ = "plans"
+
+    user_id = db.Column(db.Integer, db.ForeignKey("users.user_id"), primary_key=True)
+    # plan_codec.VERSION the plan was encoded with
+    version = db.Column(db.Integer, nullable=False)
+    data = db.Column(db.LargeBinary, nullable=False)
+
+    def __repr__(self):
+        """Provide helpful representation when printed"""
+
+        string = "<StoredPlan User id: {}, version: {}, {} bytes>"
+        return string.format(self.user_id, self.version, len(self.data))
+
+
+class Job(db.Model):
+    """A piece of background work, queued here and run by jobs.JobQueue"""
+
+    __tablename__ = "jobs"
+
+    job_id = db.Column(db.Integer, primary_key=True, autoincrement=True)
+    # which handler runs it, see jobs.HANDLERS
+    kind = db.Column(db.String(20), nullable=False)
+    user_id = db.Column(db.Integer, db.ForeignKey("users.user_id"), nullable=True)
+    # queued, running, done or failed
+    status = db.Column(db.String(10), nullable=False, default="queued")
+    attempts = db.Column(db.Integer, nullable=False, default=0)
+    # json from the handler when done, the exception when failed
+    result = db.Column(db.Text, nullable=True)
+    error = db.Column(db.Text, nullable=True)
+    # unix times
+    created_at = db.Column(db.Float, nullable=False)
+    started_at = db.Column(db.Float, nullable=True)
+    finished_at = db.Column(db.Float, nullable=True)
+
+    __table_args__ = (
+        # workers claim the oldest queued job
+        db.Index("ix_jobs_status_job_id", "status", "job_id"),
+        # enqueue() looks for a job already queued for the user
+        db.Index("ix_jobs_user_id_kind", "user_id", "kind"),
+    )
+
+    def __repr__(self):
+        """Provide helpful representation when printed"""
+
+        string = "<Job id: {}, kind: {}, User id: {}, status: {}>"
+        return string.format(self.job_id, self.kind, self.user_id, self.status)
+
+
+@event.listens_for(Race, "before_insert")
+def set_race_VDOT(mapper, connection, race):
+    """Store VDOT on a race as it is inserted"""
+
+    if race.vdot is None:
+        race.vdot = race.calculate_VDOT()
+
+
+@event.listens_for(Race, "after_insert")
+def point_user_at_new_race(mapper, connection, race):
+    """Move users.latest_race_id to a newly inserted race and fold it into fitness_vdot"""
+
+    race_added(connection, race.user_id, race.race_id, race.vdot)
+
+
+# weight of the newest race in users.fitness_vdot, each earlier race counts
+# (1 - FITNESS_ALPHA) times as much as the one after it
+FITNESS_ALPHA = 0.5
+
+
+def fitness_update(VDOT):
+    """Return the users.fitness_vdot expression that folds in a race of VDOT"""
+
+    fitness = User.__table__.c.fitness_vdot
+    return case((fitness.is_(None), VDOT), else_=FITNESS_ALPHA * VDOT + (1 - FITNESS_ALPHA) * fitness)
+
+
+def fitness_VDOT(VDOTs):
+    """Return the fitness VDOT of a race history, oldest race first
+
+    the reference for the incremental update in race_added()
+
+    >>> fitness_VDOT([40, 50, 48])
+    46.5
+    >>> fitness_VDOT([]) is None
+    True
+
+    """
+    fitness = None
+    for VDOT in VDOTs:
+        fitness = VDOT if fitness is None else FITNESS_ALPHA * VDOT + (1 - FITNESS_ALPHA) * fitness
+    return fitness
+
+
+def race_added(connection, user_id, race_id, VDOT):
+    """Update a user for a new race in one statement, return their new fitness VDOT
+
+    moves latest_race_id and folds VDOT into fitness_vdot
+    """
+
+    users = User.__table__
+    latest = db.func.max(db.func.coalesce(users.c.latest_race_id, 0), race_id)
+    return connection.execute(
+        users.update().where(users.c.user_id == user_id)
+        .values(latest_race_id=latest, fitness_vdot=fitness_update(VDOT))
+        .returning(users.c.fitness_vdot)).scalar_one()
+
+
 class Pace(object):
     """Store paces Easy, Marathon, and Temo as range of percentages
 
@@ -99,18 +294,18 @@ class Pace(object):
         "tempo": (0.83, 0.86, 0.89)
     }
 
+    __slots__ = ("VDOT", "intensity", "_velocity")
+
     def __init__(self, VDOT, intensity):
         self.VDOT = VDOT
         self.intensity = intensity
+        self._velocity = None
 
     def pace_range(self):
         """Return the range of times in minutes/mile for a given intensity"""
 
-        intensity_tuple = self.PACE_DICT[self.intensity]
         p_range = []
-        for t in intensity_tuple:
-            percent_VDOT = self.VDOT * t
-            velocity = calculator.get_velocity_from_VO2(percent_VDOT)
+        for velocity in self.velocity():
             miles_per_min = velocity / 1609.34
             minutes_per_mile = 1 / miles_per_min
             # minutes_per_mile = timedelta(minutes=(1/miles_per_min))
@@ -118,15 +313,24 @@ class Pace(object):
         return p_range
 
     def velocity(self):
-        """Return list of velocity (low, avg, high) in meters/minute for a given intensity"""
+        """Return list of velocity (low, avg, high) in meters/minute for a given intensity
+
+        looked up once from PACE_TABLE, see pace_table.py for the error bound
+        """
+
+        if self._velocity is None:
+            self._velocity = PACE_TABLE.velocity(self.VDOT, self.intensity).tolist()
+        return self._velocity
 
-        intensity_tuple = self.PACE_DICT[self.intensity]
-        velocity_range = []
-        for t in intensity_tuple:
-            percent_VDOT = self.VDOT * t
-            velocity = calculator.get_velocity_from_VO2(percent_VDOT)
-            velocity_range.append(velocity)
-        return velocity_range
+    def as_dict(self):
+        """Return dict of raw pace values (low, avg, high) for the json api"""
+
+        return {
+            "intensity": self.intensity,
+            "VDOT": self.VDOT,
+            "velocity": self.velocity(),
+            "seconds_per_mile": [60 * 1609.34 / velocity for velocity in self.velocity()],
+        }
 
     def convert_timedelta(self):
         """Return list of pace times (low, avg, high) converted from timedelta object"""
@@ -154,169 +358,428 @@ class Pace(object):
             return string.format(self.intensity)
 
 
+PACE_TABLE = pace_table.PaceTable(Pace.PACE_DICT)
+
+
+################################################################################
+# Plan Templates
+
+PLAN_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "plans")
+
+DEFAULT_PLAN = "marathon-18"
+
+# one segment of a template, total_time and fixed_meters precomputed at load
+SegmentSpec = namedtuple("SegmentSpec", ["intensity", "rep", "time", "rest", "distance_in_miles",
+                                         "distance_as_percent", "total_time", "fixed_meters"])
+
+
+class PlanTemplate(object):
+    """Plan definition read from plans/<name>.json and compiled once
+
+    weeks is a tuple of (percent_peak_mileage, workouts), each workout a
+    tuple of choices and each choice a tuple of SegmentSpec. A choice of
+    more than one spec ("shorter_of" in the file) runs the shortest of them.
+
+    Building a week for a user only scales the specs by the user's mileage
+    and pace, the file is never parsed again and only the chosen segment of
+    a choice is constructed.
+    """
+
+    def __init__(self, name, weeks, days=6, description=""):
+        self.name = name
+        self.weeks = weeks
+        self.days = days
+        self.description = description
+
+    @classmethod
+    def load(cls, path):
+        """Return PlanTemplate compiled from a json plan file"""
+
+        with open(path) as plan_file:
+            data = json.load(plan_file)
+        weeks = tuple(
+            (week["percent_peak_mileage"],
+             tuple(tuple(cls.compile_choice(segment) for segment in workout)
+                   for workout in week["workouts"]))
+            for week in data["weeks"])
+        return cls(data["name"], weeks, data.get("days", 6), data.get("description", ""))
+
+    @staticmethod
+    def compile_choice(segment):
+        """Return tuple of SegmentSpec for one segment, or a "shorter_of" list"""
+
+        choice = ()
+        for spec in segment.get("shorter_of", [segment]):
+            rep = spec.get("rep", 1)
+            time = spec.get("time")
+            distance_in_miles = spec.get("distance_in_miles")
+            choice += (SegmentSpec(
+                intensity=spec["intensity"],
+                rep=rep,
+                time=time,
+                rest=spec.get("rest"),
+                distance_in_miles=distance_in_miles,
+                distance_as_percent=spec.get("distance_as_percent"),
+                total_time=time * rep if time else None,
+                fixed_meters=calculator.miles_to_meters(distance_in_miles) if distance_in_miles else None),)
+        return choice
+
+    @staticmethod
+    def spec_distance(spec, context):
+        """Return distance in meters a spec would cover for a PlanContext
+
+        matches Segment.calc_distance() without building the Segment
+        """
+
+        if spec.total_time:
+            return context.paces(spec.intensity).velocity()[1] * spec.total_time
+        if spec.fixed_meters:
+            return spec.fixed_meters
+        if spec.distance_as_percent:
+            return spec.distance_as_percent * calculator.miles_to_meters(context.weekly_mileage)
+        return None
+
+    def pick(self, choice, context):
+        """Return the SegmentSpec a choice runs for a PlanContext, the shortest of a "shorter_of" """
+
+        if len(choice) == 1:
+            return choice[0]
+        return min(choice, key=lambda spec: self.spec_distance(spec, context))
+
+    def picks(self, index, context):
+        """Return tuple of the SegmentSpecs week number index (from 0) runs for a PlanContext"""
+
+        percent_peak_mileage, workouts = self.weeks[index]
+        return tuple(self.pick(choice, context) for workout in workouts for choice in workout)
+
+    def build_week(self, index, context, plan):
+        """Return Week number index (from 0) of this template for a PlanContext"""
+
+        percent_peak_mileage, workouts = self.weeks[index]
+        built = ()
+        for workout in workouts:
+            segments = []
+            for choice in workout:
+                spec = self.pick(choice, context)
+                segments.append(Segment(spec.intensity, context, rep=spec.rep, time=spec.time,
+                                        distance_in_miles=spec.distance_in_miles,
+                                        distance_as_percent=spec.distance_as_percent,
+                                        rest=spec.rest))
+            built += (Workout(*segments),)
+        return Week(context, percent_peak_mileage, plan=plan, workouts=built, days=self.days)
+
+    def __repr__(self):
+        """Provide helpful representation when printed"""
+
+        string = "<PlanTemplate {}, {} weeks>"
+        return string.format(self.name, len(self.weeks))
+
+
+def load_plan_templates(plan_dir=PLAN_DIR):
+    """Return dict of name to compiled PlanTemplate for every json file in plan_dir"""
+
+    templates = {}
+    for path in sorted(glob.glob(os.path.join(plan_dir, "*.json"))):
+        template = PlanTemplate.load(path)
+        templates[template.name] = template
+    return templates
+
+
+PLAN_TEMPLATES = load_plan_templates()
+
+
+class PlanContext(object):
+    """Inputs resolved once per plan build: VDOT and weekly mileage
+
+    Stands in for the User wherever Week and Segment used to ask for
+    user.paces() or user.weekly_mileage, so building a plan costs a single
+    race lookup instead of one query per Segment.
+    """
+
+    __slots__ = ("VDOT", "weekly_mileage", "_paces")
+
+    def __init__(self, VDOT, weekly_mileage):
+        self.VDOT = VDOT
+        self.weekly_mileage = weekly_mileage
+        self._paces = {}
+
+    @classmethod
+    def from_user(cls, user, precision=None):
+        """Return PlanContext from a user's fitness VDOT
+
+        VDOT is rounded to precision decimal places when given
+        """
+
+        VDOT = user.fitness_VDOT()
+        if precision is not None:
+            VDOT = round(VDOT, precision)
+        return cls(VDOT, user.weekly_mileage)
+
+    def paces(self, intensity):
+        """Return object of Pace class, shared by every segment of the plan"""
+
+        pace_obj = self._paces.get(intensity)
+        if pace_obj is None:
+            pace_obj = Pace(self.VDOT, intensity)
+            self._paces[intensity] = pace_obj
+        return pace_obj
+
+    def __repr__(self):
+        """Provide helpful representation when printed"""
+
+        string = "<PlanContext VDOT = {} Max Weekly Mileage = {}>"
+        return string.format(self.VDOT, self.weekly_mileage)
+
+
+class PlanCache(cache.LRUCache):
+    """LRU cache of TrainingPlans keyed by (VDOT, weekly mileage, start date, template, history)
+
+    A plan is a pure function of those, so users with the same inputs,
+    and repeat views by the same user, share one plan. history is empty
+    unless the plan was re-planned, see TrainingPlan. VDOT is rounded to
+    precision decimal places before it is used as a key and before the
+    plan is built, so every hit matches what a rebuild would give.
+    """
+
+    def __init__(self, maxsize=256, precision=1):
+        super(PlanCache, self).__init__(maxsize)
+        self.precision = precision
+
+    def context_for(self, user):
+        """Return PlanContext for user with VDOT rounded for this cache"""
+
+        return PlanContext.from_user(user, precision=self.precision)
+
+    def key(self, context, start_date=None, template=None, history=()):
+        """Return the cache key for a PlanContext, the inputs a plan depends on
+
+        history is a tuple of (stop_week, VDOT, weekly_mileage) for the
+        weeks planned before context, see TrainingPlan
+        """
+
+        if start_date is None:
+            start_date = next_monday()
+        return (context.VDOT, context.weekly_mileage, start_date, template or DEFAULT_PLAN, history)
+
+    def key_for(self, user, context=None):
+        """Return the cache key of user's plan
+
+        the revisions in user.plan_history when the user has some, see
+        User.replan(); otherwise next Monday's plan for their current
+        fitness. Pass context when the caller already has one from
+        context_for().
+        """
+
+        if user.plan_start is None or not user.plan_history:
+            return self.key(context or self.context_for(user))
+        revisions = json.loads(user.plan_history)
+        history = tuple((stop_week, VDOT, weekly_mileage)
+                        for (from_week, VDOT, weekly_mileage), (stop_week, _, _) in zip(revisions, revisions[1:]))
+        from_week, VDOT, weekly_mileage = revisions[-1]
+        return self.key(PlanContext(VDOT, weekly_mileage), user.plan_start, history=history)
+
+    def plan_for(self, user, context=None):
+        """Return the TrainingPlan for user, built only on a cache miss"""
+
+        return self.plan_for_key(self.key_for(user, context))
+
+    def plan_for_key(self, key):
+        """Return the TrainingPlan for a cache key, built only on a cache miss"""
+
+        return self.get_or_build(key, lambda: build_plan(key))
+
+
+def build_plan(key):
+    """Return TrainingPlan for a PlanCache key, picklable for process pools"""
+
+    VDOT, weekly_mileage, start_date, template, history = key
+    history = tuple((stop_week, PlanContext(VDOT_then, mileage_then))
+                    for stop_week, VDOT_then, mileage_then in history)
+    return TrainingPlan(PlanContext(VDOT, weekly_mileage), start_date, template, history=history)
+
+
+def build_plan_json(key):
+    """Return json text of the TrainingPlan for a PlanCache key
+
+    goes through the PLAN_CACHE of whichever process runs it, so it can be
+    handed to a process pool as well as called inline
+    """
+
+    training_plan = PLAN_CACHE.plan_for_key(key)
+    return json.dumps(training_plan.as_dict())
+
+
 class TrainingPlan(object):
-    """Return list of 18 Week objects for a user
+    """Return list of Week objects for a PlanContext, one per template week
 
     each Week object contains a tuple of Workout objects
     each Workout object contains a tuple of Segment objects
+
+    The user's race and VDOT are looked up once, in a PlanContext, which is
+    what gets passed down to every Week and Segment. The weeks themselves
+    come from a compiled PlanTemplate, see plans/. Use User.training_plan()
+    to go through the plan cache.
+
+    Weeks are built lazily, the first time they are asked for through
+    week(), plan[i], plan[i:j] or iter_weeks(); .weeks builds them all.
+    Pass build=True to build every week up front.
+
+    A re-planned plan (see replan()) has a history of (stop_week,
+    PlanContext): the weeks before stop_week that aren't covered by an
+    earlier entry were planned with that PlanContext, the rest with context.
     """
 
-    def __init__(self, user):
-        self.weeks = []
+    def __init__(self, context, start_date=None, template=None, build=False, history=()):
+        self.context = context
+        self.history = history
+        self.template = PLAN_TEMPLATES[template or DEFAULT_PLAN]
+        self.template_name = self.template.name
+        # start_date will be the next Monday unless given
+        self.start_date = start_date or next_monday()
+        # None until built, see week()
+        self._weeks = [None] * len(self.template.weeks)
         self.days = self.make_list_of_days()
+        if build:
+            for i in range(len(self)):
+                self.week(i)
+
+    @property
+    def weeks(self):
+        """Return list of every Week, building any not built yet"""
+
+        return [self.week(i) for i in range(len(self))]
+
+    def week(self, index):
+        """Return Week number index (from 0), building it on first use"""
+
+        week = self._weeks[index]
+        if week is None:
+            started = time.perf_counter()
+            week = self.build_week(index)
+            metrics.observe_plan_week(time.perf_counter() - started)
+            self._weeks[index] = week
+        return week
+
+    def build_week(self, index):
+        """Return Week number index (from 0) built from the template, see week()"""
+
+        return self.template.build_week(index, self.context_for_week(index), plan=self)
+
+    def context_for_week(self, index):
+        """Return the PlanContext week number index (from 0) is planned with"""
+
+        for stop_week, context in self.history:
+            if index < stop_week:
+                return context
+        return self.context
+
+    def replan(self, context, from_week):
+        """Return a plan that keeps the weeks before from_week and plans the rest for context
+
+        Weeks already built are rescaled rather than rebuilt, see
+        Week.rescaled(): distances that are a share of weekly mileage for a
+        mileage change, paces and the distances run for time for a VDOT
+        change, and the easy days' share of what's left either way. A week whose "shorter_of"
+        choices would now pick differently is built again, and weeks not
+        built yet stay lazy. This plan is left as it is, it may be shared
+        through PLAN_CACHE; the weeks kept are shared with it.
+
+        The result is the plan build_plan() makes from the user's stored
+        revisions, rescaled weeks included:
+
+        >>> plan = TrainingPlan(PlanContext(48.5, 50), date(2016, 3, 7), build=True)
+        >>> user = User(plan_start=date(2016, 3, 7))
+        >>> for VDOT, mileage in [(52.3, 50), (48.5, 35), (35.2, 20), (30.4, 80)]:
+        ...     user.plan_history = json.dumps([[0, 48.5, 50], [6, VDOT, mileage]])
+        ...     replanned = plan.replan(PlanContext(VDOT, mileage), 6)
+        ...     rebuilt = len(replanned) - replanned.built_weeks()
+        ...     same = replanned.as_dict() == build_plan(PLAN_CACHE.key_for(user)).as_dict()
+        ...     print(same, rebuilt, "weeks rebuilt")
+        True 0 weeks rebuilt
+        True 0 weeks rebuilt
+        True 0 weeks rebuilt
+        True 7 weeks rebuilt
+        """
 
-        # week 1 - 3
-        self.weeks.append(Week(user, 0.60, plan=self, workouts=()))
-        self.weeks.append(Week(user, 0.60, plan=self, workouts=()))
-        self.weeks.append(Week(user, 0.60, plan=self, workouts=()))
-        # week 4 - 6
-        self.weeks.append(Week(user, 0.60, plan=self, workouts=(
-            Workout(
-                Segment(intensity='easy', user=user, distance_as_percent=0.162),
-            ),
-        )))
-        self.weeks.append(Week(user, 0.60, plan=self, workouts=(
-            Workout(
-                Segment(intensity='easy', user=user, distance_as_percent=0.162),
-            ),
-        )))
-        self.weeks.append(Week(user, 0.60, plan=self, workouts=(
-            Workout(
-                Segment(intensity='easy', user=user, distance_as_percent=0.162),
-            ),
-        )))
-        # weeks 7 & 8
-        self.weeks.append(Week(user, 0.80, plan=self, workouts=(
-            Workout(
-                # this workout calls for the shorter of these two segments
-                (Segment(intensity='easy', user=user, distance_as_percent=0.216),
-                 Segment(intensity='easy', user=user, time=150)),
-                ),
-            Workout(
-                Segment(intensity='tempo', user=user, rep=2, time=10, rest=1),
-            ),
-        )))
-        self.weeks.append(Week(user, 0.80, plan=self, workouts=(
-            Workout(
-                # this workout calls for the shorter of these two segments
-                (Segment(intensity='easy', user=user, distance_as_percent=0.216),
-                 Segment(intensity='easy', user=user, time=150)),
-            ),
-            Workout(
-                Segment(intensity='tempo', user=user, rep=2, time=10, rest=1),
-            ),
-        )))
-        # week 9
-        self.weeks.append(Week(user, 0.70, plan=self, workouts=(
-            Workout(
-                Segment(intensity='easy', user=user, distance_as_percent=0.0945),
-                Segment(intensity='easy', user=user, distance_as_percent=0.0945),
-            ),
-            Workout(
-                Segment(intensity='tempo', user=user, rep=2, time=15, rest=1),
-            ),
-        )))
-        # week 10 and 11
-        self.weeks.append(Week(user, 0.90, plan=self, workouts=(
-            Workout(
-                # this workout calls for the shorter of these two segments
-                (Segment(intensity='easy', user=user, distance_as_percent=0.243),
-                 Segment(intensity='easy', user=user, time=150)),
-            ),
-            Workout(
-                Segment(intensity='tempo', user=user, rep=3, time=10, rest=1),
-            ),
-        )))
-        self.weeks.append(Week(user, 0.90, plan=self, workouts=(
-            Workout(
-                # this workout calls for the shorter of these two segments
-                (Segment(intensity='easy', user=user, distance_as_percent=0.243),
-                 Segment(intensity='easy', user=user, time=150)),
-            ),
-            Workout(
-                Segment(intensity='tempo', user=user, rep=3, time=10, rest=1),
-            ),
-        )))
-        # week 12
-        self.weeks.append(Week(user, 0.70, plan=self, workouts=(
-            Workout(
-                # this workout calls for the shorter of these two segments
-                (Segment(intensity='marathon', user=user, distance_in_miles=12),
-                 Segment(intensity='marathon', user=user, time=120)),
-            ),
-            Workout(
-                Segment(intensity='tempo', user=user, rep=2, time=15, rest=1),
-            ),
-        )))
-        # week 13
-        self.weeks.append(Week(user, 1.0, plan=self, workouts=(
-            Workout(
-                Segment(intensity='tempo', user=user, rep=3, time=5, rest=1),
-                Segment(intensity='easy', user=user, time=60),
-                Segment(intensity='tempo', user=user, rep=3, time=5, rest=1),
-            ),
-            Workout(
-                Segment(intensity='tempo', user=user, rep=2, time=10, rest=2),
-                Segment(intensity='easy', user=user, time=75)
-                ),
-        )))
-        # week 14
-        self.weeks.append(Week(user, 0.90, plan=self, workouts=(
-            Workout(
-                # this workout calls for the shorter of these two segments
-                (Segment(intensity='marathon', user=user, distance_in_miles=15),
-                 Segment(intensity='marathon', user=user, time=150)),
-            ),
-            Workout(
-                Segment(intensity='tempo', user=user, rep=2, time=10, rest=2),
-                Segment(intensity='easy', user=user, time=75),
-            ),
-        )))
-        # week 15
-        self.weeks.append(Week(user, 1.0, plan=self, workouts=(
-            Workout(
-                Segment(intensity='easy', user=user, distance_as_percent=0.25),
-            ),
-            Workout(
-                Segment(intensity='tempo', user=user, rep=2, time=10, rest=2),
-                Segment(intensity='easy', user=user, time=75),
-            ),
-        )))
-        # week 16
-        self.weeks.append(Week(user, 0.80, plan=self, workouts=(
-            Workout(
-                Segment(intensity='tempo', user=user, rep=3, time=5, rest=1),
-                Segment(intensity='easy', user=user, time=60),
-                Segment(intensity='tempo', user=user, rep=3, time=5, rest=1),
-            ),
-            Workout(
-                Segment(intensity='tempo', user=user, rep=2, time=10, rest=2),
-                Segment(intensity='easy', user=user, time=75),
-            ),
-        )))
-        # week 17
-        self.weeks.append(Week(user, 0.80, plan=self, workouts=(
-            Workout(
-                # this workout calls for the shorter of these two segments
-                (Segment(intensity='marathon', user=user, distance_in_miles=12),
-                 Segment(intensity='marathon', user=user, time=120)),
-            ),
-            Workout(
-                Segment(intensity='easy', user=user, distance_in_miles=2),
-                Segment(intensity='tempo', user=user, rep=5, time=5, rest=1),
-            ),
-        )))
-        # week 18
-        self.weeks.append(Week(user, 0.60, plan=self, workouts=(
-            Workout(
-                Segment(intensity='easy', user=user, distance_as_percent=0.081),
-                Segment(intensity='easy', user=user, distance_as_percent=0.081),
-            ),
-            Workout(
-                Segment(intensity='easy', user=user, distance_in_miles=2),
-                Segment(intensity='tempo', user=user, rep=5, time=5, rest=1),
-            ),
-        )))
+        history = []
+        start = 0
+        for stop_week, old_context in self.history + ((len(self), self.context),):
+            if start >= from_week:
+                break
+            history.append((min(stop_week, from_week), old_context))
+            start = stop_week
+        plan = TrainingPlan(context, self.start_date, self.template.name, history=tuple(history))
+
+        for index, week in enumerate(self._weeks):
+            if week is None:
+                continue
+            if index < from_week:
+                plan._weeks[index] = week
+            elif self.template.picks(index, week.user) == self.template.picks(index, context):
+                plan._weeks[index] = week.rescaled(context, plan)
+        return plan
+
+    def built_weeks(self):
+        """Return how many weeks have been built so far"""
+
+        return sum(1 for week in self._weeks if week is not None)
+
+    def iter_weeks(self, start=0, stop=None):
+        """Yield Weeks start to stop (from 0, stop exclusive), building each as it is reached"""
+
+        if stop is None:
+            stop = len(self)
+        for i in range(start, stop):
+            yield self.week(i)
+
+    def __len__(self):
+        return len(self._weeks)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self.week(i) for i in range(*index.indices(len(self)))]
+        if index < 0:
+            index += len(self)
+        return self.week(index)
+
+    def __iter__(self):
+        return self.iter_weeks()
+
+    def as_dict(self):
+        """Return dict of the plan summary and every week, see Week.as_dict()"""
+
+        return {
+            "plan": self.summary(),
+            "weeks": [week.as_dict(self.week_days(i)) for i, week in enumerate(self.iter_weeks())],
+        }
+
+    def calendar(self, start=0, stop=None):
+        """Return list of weeks start to stop, each a list of (date, Workout) for display"""
+
+        return [list(zip(self.week_days(i), week.workouts))
+                for i, week in enumerate(self.iter_weeks(start, stop), start)]
+
+    def week_days(self, index):
+        """Return the 7 dates of week number index (from 0)"""
+
+        return self.days[index * 7:(index + 1) * 7]
+
+    def summary(self):
+        """Return dict of the inputs and shape of the plan, for the json api"""
+
+        return {
+            "VDOT": self.context.VDOT,
+            "weekly_mileage": self.context.weekly_mileage,
+            "template": self.template_name,
+            "start_date": self.start_date.isoformat(),
+            "weeks": len(self),
+            "paces": dict((intensity, self.context.paces(intensity).as_dict())
+                          for intensity in Pace.PACE_DICT),
+            # earlier inputs of a re-planned plan, see replan()
+            "history": [{"until_week": stop_week, "VDOT": context.VDOT,
+                         "weekly_mileage": context.weekly_mileage}
+                        for stop_week, context in self.history],
+        }
 
     def make_list_of_days(self):
         """Makes list of the calendar datetime objects for the training_plan
@@ -326,17 +789,10 @@ class TrainingPlan(object):
         see python docs for additional datetime methods
         """
 
-        days = []
-        today = date.today()
-        # start_date will be the next Monday
-        day_of_week = today.weekday()
-        offset = -day_of_week % 7
-        start_date = today + timedelta(days=offset)
-        # 18 weeks * 7 day/week = 126 days,
-        for i in range(126):
-            current_day = start_date + timedelta(days=i)
-            days.append(current_day)
-        return days
+        # 18 weeks * 7 day/week = 126 days, for the default template;
+        # date.fromordinal() is a few times quicker than adding timedeltas
+        start = self.start_date.toordinal()
+        return [date.fromordinal(start + i) for i in range(len(self) * 7)]
 
 
 class Week(object):
@@ -347,6 +803,11 @@ class Week(object):
 
     The lesser of two workouts my be selected for by passing workouts in as a tuple
     """
+
+    # plans are held in PLAN_CACHE, slots keep each object small
+    __slots__ = ("user", "percent_peak_mileage", "peakmileage", "week_in_meters", "plan",
+                 "days", "quality_days", "quality_distance", "workouts", "distance")
+
 # TODO(kara): if time change units on User.weekly_mileage
     def __init__(self, user, percent_peak_mileage, plan, workouts, days=6):
         self.user = user
@@ -358,6 +819,8 @@ class Week(object):
         # self.week_in_miles = (self.percent_peak_mileage * self.peakmileage)
         self.plan = plan
         self.days = days
+        # the template's workouts come first, then easy days, then rest days
+        self.quality_days = len(workouts)
         self.quality_distance = sum(workout.distance for workout in workouts)
         self.workouts = self.create_remaining_days(workouts)
         for workout in self.workouts:
@@ -377,17 +840,62 @@ class Week(object):
         rem_dist = self.week_in_meters - self.quality_distance
         # divide rem_dist between remaining days
         distance = rem_dist/days
+        workouts = list(workouts)
         # for each remaining day create an instance of Workout, intensity=easy
         for i in range(days):
             seg = Segment(intensity="easy", user=self.user)
             seg.distance = distance
-            workout = Workout(seg)
-            workouts = workouts + (workout,)
+            workouts.append(Workout(seg))
         # adjust if user specified days is less than 7
         remainder_of_seven = 7 - len(workouts)
         for i in range(remainder_of_seven):
-            workouts = workouts + (Workout(),)
-        return workouts
+            workouts.append(Workout())
+        return tuple(workouts)
+
+    def rescaled(self, context, plan):
+        """Return a copy of the week for another PlanContext, as part of plan
+
+        see TrainingPlan.replan(). The quality workouts are rescaled segment
+        by segment, then the easy days share what's left of the week's
+        distance; this week is left as it is.
+        """
+
+        week = object.__new__(Week)
+        week.user = context
+        week.percent_peak_mileage = self.percent_peak_mileage
+        week.peakmileage = self.peakmileage
+        week.week_in_meters = self.week_in_meters
+        if context.weekly_mileage != self.user.weekly_mileage:
+            week.peakmileage = calculator.miles_to_meters(context.weekly_mileage)
+            week.week_in_meters = week.percent_peak_mileage * week.peakmileage
+        week.plan = plan
+        week.days = self.days
+        week.quality_days = self.quality_days
+        workouts = tuple(workout.rescaled(context, week) for workout in self.workouts)
+        week.quality_distance = sum(workout.distance for workout in workouts[:self.quality_days])
+
+        easy = [workout for workout in workouts[self.quality_days:] if workout.segments]
+        if easy:
+            distance = (week.week_in_meters - week.quality_distance) / len(easy)
+            for workout in easy:
+                workout.segments[0].distance = distance
+                workout.distance = distance
+        week.workouts = workouts
+        week.distance = sum(workout.distance for workout in workouts)
+        return week
+
+    def as_dict(self, days):
+        """Return dict of raw week values, days are the week's 7 dates
+
+        distances in meters, see Workout.as_dict() and Segment.as_dict()
+        """
+
+        return {
+            "percent_peak_mileage": self.percent_peak_mileage,
+            "distance": self.distance,
+            "workouts": [dict(workout.as_dict(), date=day.isoformat())
+                         for day, workout in zip(days, self.workouts)],
+        }
 
     def show_week(self):
         """String representation of week distance. For user display"""
@@ -408,6 +916,8 @@ class Workout(object):
     # segments should only accept a tuple
     # use segment.distance() to get distance of workout.
 
+    __slots__ = ("segments", "distance", "week")
+
     def __init__(self, *segments):
         self.segments = self.final_segments(segments)
         self.distance = sum(seg.calc_distance() for seg in self.segments)
@@ -417,26 +927,36 @@ class Workout(object):
     def final_segments(self, segments):
         """Return the less of two segments when tuple passed for segment"""
 
-        # make new tuple to hold individual segment objects
-        final_segments = ()
+        # make new list to hold individual segment objects
+        final_segments = []
         # loop over segments to:
             # find shortest in a tuple, construct tuple of just segment objects
             # assign the 'parent' workout
-        for i in range(len(segments)):
-            segment = segments[i]
+        for segment in segments:
             if isinstance(segment, tuple):
-                tup = segment
                 # find smaller segment in the tuple
-                seg = min(tup, key=lambda x: x.distance)
-                # add smaller segment to tuple
-                final_segments = final_segments + (seg,)
-                seg.workout = self
-            # add all other segment objects to the tuple
-            else:
-                final_segments = final_segments + (segment,)
+                segment = min(segment, key=lambda x: x.calc_distance())
+            final_segments.append(segment)
             # adds bi-directional accountability, linked to parent instance
-                segment.workout = self
-        return final_segments
+            segment.workout = self
+        return tuple(final_segments)
+
+    def rescaled(self, context, week):
+        """Return a copy of the workout for another PlanContext, as part of week"""
+
+        workout = object.__new__(Workout)
+        workout.week = week
+        workout.segments = tuple(segment.rescaled(context, workout) for segment in self.segments)
+        workout.distance = sum(seg.calc_distance() for seg in workout.segments)
+        return workout
+
+    def as_dict(self):
+        """Return dict of raw workout values, a rest day has no segments"""
+
+        return {
+            "distance": self.distance,
+            "segments": [segment.as_dict() for segment in self.segments],
+        }
 
     def show_workout(self):
         """String representation of workout distance. For user display"""
@@ -456,6 +976,9 @@ class Workout(object):
 class Segment(object):
     """Pace() and distance or time components of a workout"""
 
+    __slots__ = ("intensity", "user", "pace", "rep", "time", "total_time", "rest", "workout",
+                 "distance_as_percent", "distance")
+
 # TODO(kara): unit test distance calculations
 
     def __init__(self, intensity, user, workout=None, rep=1, time=None, distance_in_miles=None,
@@ -463,12 +986,13 @@ class Segment(object):
 
         # intensity is the STRING: "easy", "marathon", or "tempo"
         self.intensity = intensity
-        # when segment is called from the User class user_id will not need to be passed in
+        # user is the plan's PlanContext (a User works too, at one query per call)
         self.user = user
-        # uses instance method from User class
+        # Pace objects are shared across the plan by PlanContext.paces()
         self.pace = user.paces(self.intensity)
         self.rep = rep
         self.time = time
+        self.total_time = None
         if time:
             self.total_time = time * rep
         # explanation of self.distance from time: if the segment was asked
@@ -480,6 +1004,8 @@ class Segment(object):
         self.workout = None
         # peakmileage in meters
         peakmileage = calculator.miles_to_meters(self.user.weekly_mileage)
+        # kept so rescaled() can follow a change of weekly mileage
+        self.distance_as_percent = None if distance_in_miles else distance_as_percent
         self.distance = None
         if distance_as_percent:
             self.distance = (distance_as_percent * peakmileage)
@@ -497,6 +1023,48 @@ class Segment(object):
             distance = self.distance
         return distance
 
+    def rescaled(self, context, workout):
+        """Return a copy of the segment for another PlanContext, as part of workout
+
+        only what context changes is recomputed: the pace for a new VDOT,
+        the distance when it is a share of a new weekly mileage
+        """
+
+        segment = object.__new__(Segment)
+        segment.intensity = self.intensity
+        segment.user = context
+        segment.pace = self.pace
+        if context.VDOT != self.user.VDOT:
+            segment.pace = context.paces(self.intensity)
+        segment.rep = self.rep
+        segment.time = self.time
+        segment.total_time = self.total_time
+        segment.rest = self.rest
+        segment.workout = workout
+        segment.distance_as_percent = self.distance_as_percent
+        segment.distance = self.distance
+        if self.distance_as_percent and context.weekly_mileage != self.user.weekly_mileage:
+            segment.distance = self.distance_as_percent * calculator.miles_to_meters(context.weekly_mileage)
+        return segment
+
+    def as_dict(self):
+        """Return dict of raw segment values
+
+        times in seconds, distances in meters; distance is None when running
+        for time and estimated_distance is what calc_distance() expects.
+        The pace for the intensity is in the plan summary, not repeated here
+        """
+
+        return {
+            "intensity": self.intensity,
+            "rep": self.rep,
+            "time": self.time * 60 if self.time else None,
+            "total_time": self.total_time * 60 if self.total_time else None,
+            "rest": self.rest * 60 if self.rest else None,
+            "distance": self.distance,
+            "estimated_distance": self.calc_distance(),
+        }
+
     def show_segment(self):
         """Return tuple containing string representation of the segment, for user display"""
 
@@ -533,15 +1101,391 @@ class Segment(object):
 # Helper Functions
 
 
-def connect_to_db(app):
-    """Connect to the database."""
-    with app.app_context():
-        app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///model.db'
-        app.config['SQLALCHEMY-ECHO'] = True
-        db.app = app
-        db.init_app(app)
-        db.create_all()
+def next_monday(today=None):
+    """Return the date of the next Monday, today if today is a Monday
 
-connect_to_db(app)
+    >>> next_monday(date(2016, 3, 2))
+    datetime.date(2016, 3, 7)
 
-print("Connected to Model.db")
+    """
+    if today is None:
+        today = date.today()
+    offset = -today.weekday() % 7
+    return today + timedelta(days=offset)
+
+
+def week_range(args, total_weeks, start_date, today=None):
+    """Return (first, last) week indexes to show, from 0 and last exclusive
+
+    >>> week_range({"weeks": "3-5"}, 18, date(2016, 3, 7))
+    (2, 5)
+    >>> week_range({"week": "18"}, 18, date(2016, 3, 7))
+    (17, 18)
+    >>> week_range({}, 18, date(2016, 3, 7), today=date(2016, 3, 22))
+    (2, 4)
+
+    a plan that has ended shows its last two weeks by default
+
+    >>> week_range({}, 18, date(2016, 3, 7), today=date(2016, 7, 25))
+    (16, 18)
+
+    """
+    weeks = args.get("weeks")
+    week = args.get("week")
+    if weeks == "all":
+        return 0, total_weeks
+    if weeks:
+        first, sep, last = weeks.partition("-")
+        first, last = int(first), int(last or first)
+    elif week:
+        first = last = int(week)
+    else:
+        # the week today falls in, the plan starts on a coming Monday
+        today = today or date.today()
+        first = min(max(0, (today - start_date).days // 7) + 1, max(1, total_weeks - 1))
+        last = first + 1
+    first = max(1, first)
+    last = min(total_weeks, last)
+    if first > last:
+        raise ValueError("no weeks {}-{} in a {} week plan".format(first, last, total_weeks))
+    return first - 1, last
+
+
+PLAN_CACHE = PlanCache()
+
+
+def refresh_latest_races(user_ids=None, connection=None):
+    """Recompute users.latest_race_id from races, for user_ids or every user
+
+    needed after inserts that bypass the ORM, like manage.py import-races.
+    Runs on connection when given, otherwise in db.session.
+    """
+
+    users = User.__table__
+    races = Race.__table__
+    latest = (db.select(db.func.max(races.c.race_id))
+              .where(races.c.user_id == users.c.user_id)
+              .scalar_subquery())
+    statement = users.update().values(latest_race_id=latest)
+    if user_ids is not None:
+        statement = statement.where(users.c.user_id.in_(list(user_ids)))
+    (connection or db.session).execute(statement)
+
+
+def recompute_fitness(user_ids=None, connection=None, chunk_size=5000):
+    """Recompute users.fitness_vdot from whole race histories, for user_ids or every user
+
+    the full pass behind the O(1) updates in race_added(): for migrations,
+    inserts that skip race_added(), and checking the stored values. Races
+    are read in (user_id, race_id) order, the index's order, chunk_size
+    rows at a time. Runs on connection when given, otherwise in db.session.
+    """
+
+    connection = connection or db.session
+    users = User.__table__
+    races = Race.__table__
+    query = (db.select(races.c.user_id, races.c.vdot, races.c.distance, races.c.time)
+             .order_by(races.c.user_id, races.c.race_id)
+             .execution_options(yield_per=chunk_size))
+    update = (users.update().where(users.c.user_id == bindparam("b_user_id"))
+              .values(fitness_vdot=bindparam("b_fitness_vdot")))
+    if user_ids is None:
+        queries = [query]
+    else:
+        # stay under SQLite's bound parameter limit
+        user_ids = sorted(user_ids)
+        queries = [query.where(races.c.user_id.in_(user_ids[i:i + 500]))
+                   for i in range(0, len(user_ids), 500)]
+
+    updates = []
+    for chunk_query in queries:
+        rows = connection.execute(chunk_query)
+        for user_id, history in groupby(rows, key=lambda row: row[0]):
+            VDOTs = [vdot if vdot is not None else calculator.user_VDOT(distance, "meters", time)
+                     for row_user_id, vdot, distance, time in history]
+            updates.append({"b_user_id": user_id, "b_fitness_vdot": fitness_VDOT(VDOTs)})
+        rows.close()
+    for i in range(0, len(updates), chunk_size):
+        connection.execute(update, updates[i:i + chunk_size])
+
+
+# columns added after a table was first created, as (table, column, type,
+# backfill). migrate_db() adds any that are missing then calls backfill(connection=...)
+COLUMN_MIGRATIONS = [
+    ("users", "latest_race_id", "INTEGER", refresh_latest_races),
+    # can be millions of rows, filled in chunks by manage.py backfill-vdot
+    ("races", "vdot", "FLOAT", None),
+    ("users", "fitness_vdot", "FLOAT", recompute_fitness),
+    # users without a plan start get one on their next replan()
+    ("users", "plan_start", "DATE", None),
+    ("users", "plan_history", "TEXT", None),
+]
+
+
+def migrate_db(connection):
+    """Bring the database on connection up to the current schema
+
+    creates missing tables, then adds missing columns and indexes to tables
+    that already exist (create_all() leaves those alone). Takes a plain
+    connection so the async engine in asgi.py can run it with run_sync().
+
+    a database from before any migration gets the new columns and indexes,
+    with latest_race_id and fitness_vdot backfilled from its races; running
+    it again changes nothing
+
+    >>> from sqlalchemy import create_engine
+    >>> engine = create_engine("sqlite://")
+    >>> with engine.begin() as connection:
+    ...     for statement in [
+    ...             "CREATE TABLE users (user_id INTEGER PRIMARY KEY, email VARCHAR(50) UNIQUE, "
+    ...             "weekly_mileage INTEGER)",
+    ...             "CREATE TABLE races (race_id INTEGER PRIMARY KEY, user_id INTEGER NOT NULL, "
+    ...             "distance INTEGER NOT NULL, time INTEGER NOT NULL)",
+    ...             "INSERT INTO users VALUES (1, 'a@example.com', 50)",
+    ...             "INSERT INTO races VALUES (1, 1, 10000, 45), (2, 1, 5000, 20)"]:
+    ...         result = connection.execute(text(statement))
+    >>> with engine.begin() as connection:
+    ...     migrate_db(connection)
+    >>> with engine.begin() as connection:
+    ...     migrate_db(connection)
+    >>> with engine.connect() as connection:
+    ...     connection.execute(text("SELECT latest_race_id, round(fitness_vdot, 2) FROM users")).all()
+    ...     sorted(index["name"] for index in inspect(connection).get_indexes("races"))
+    [(2, 47.53)]
+    ['ix_races_user_id_race_id', 'ix_races_vdot']
+    """
+
+    db.metadata.create_all(connection)
+    inspector = inspect(connection)
+    backfills = []
+    for table, column, column_type, backfill in COLUMN_MIGRATIONS:
+        columns = set(c["name"] for c in inspector.get_columns(table))
+        if column not in columns:
+            connection.execute(text("ALTER TABLE {} ADD COLUMN {} {}".format(table, column, column_type)))
+            if backfill is not None:
+                backfills.append(backfill)
+    for table in db.metadata.sorted_tables:
+        for index in table.indexes:
+            index.create(bind=connection, checkfirst=True)
+    for backfill in backfills:
+        backfill(connection=connection)
+
+
+def init_db():
+    """Create or migrate the schema of the current app's database, in one transaction"""
+
+    with db.engine.begin() as connection:
+        migrate_db(connection)
+
+
+################################################################################
+# SQLite profile and write path
+
+
+# app.config defaults, see apply_sqlite_profile()
+SQLITE_PROFILE = {
+    # readers don't block the writer, the writer doesn't block readers
+    "SQLITE_JOURNAL_MODE": "WAL",
+    # in WAL mode NORMAL only syncs at checkpoints, still safe against corruption
+    "SQLITE_SYNCHRONOUS": "NORMAL",
+    # milliseconds to wait for the write lock before "database is locked"
+    "SQLITE_BUSY_TIMEOUT": 5000,
+    "SQLITE_MMAP_SIZE": 256 * 1024 * 1024,
+    "SQLITE_POOL_SIZE": 5,
+    "SQLITE_MAX_OVERFLOW": 10,
+}
+
+JOURNAL_MODES = ("DELETE", "TRUNCATE", "PERSIST", "MEMORY", "WAL", "OFF")
+
+SYNCHRONOUS_LEVELS = ("OFF", "NORMAL", "FULL", "EXTRA")
+
+
+def sqlite_pragmas(config):
+    """Return the PRAGMA statements for the SQLite profile in config
+
+    >>> sqlite_pragmas({"SQLITE_SYNCHRONOUS": "full"})[:2]
+    ['PRAGMA journal_mode=WAL', 'PRAGMA synchronous=FULL']
+    >>> sqlite_pragmas({"SQLITE_JOURNAL_MODE": "fast"})
+    Traceback (most recent call last):
+        ...
+    ValueError: SQLITE_JOURNAL_MODE must be one of DELETE, TRUNCATE, PERSIST, MEMORY, WAL, OFF
+
+    """
+    def setting(name):
+        return config.get(name, SQLITE_PROFILE[name])
+
+    journal_mode = str(setting("SQLITE_JOURNAL_MODE")).upper()
+    if journal_mode not in JOURNAL_MODES:
+        raise ValueError("SQLITE_JOURNAL_MODE must be one of " + ", ".join(JOURNAL_MODES))
+    synchronous = str(setting("SQLITE_SYNCHRONOUS")).upper()
+    if synchronous not in SYNCHRONOUS_LEVELS:
+        raise ValueError("SQLITE_SYNCHRONOUS must be one of " + ", ".join(SYNCHRONOUS_LEVELS))
+    return [
+        "PRAGMA journal_mode={}".format(journal_mode),
+        "PRAGMA synchronous={}".format(synchronous),
+        "PRAGMA busy_timeout={:d}".format(int(setting("SQLITE_BUSY_TIMEOUT"))),
+        "PRAGMA mmap_size={:d}".format(int(setting("SQLITE_MMAP_SIZE"))),
+    ]
+
+
+def apply_sqlite_profile(engine, config):
+    """Run the SQLite profile's pragmas on every new connection engine opens"""
+
+    pragmas = sqlite_pragmas(config)
+
+    @event.listens_for(engine, "connect")
+    def set_pragmas(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        for pragma in pragmas:
+            cursor.execute(pragma)
+        cursor.close()
+
+
+def sqlite_engine_options(config):
+    """Return SQLALCHEMY_ENGINE_OPTIONS for the connection pool in config"""
+
+    return {
+        "pool_size": int(config.get("SQLITE_POOL_SIZE", SQLITE_PROFILE["SQLITE_POOL_SIZE"])),
+        "max_overflow": int(config.get("SQLITE_MAX_OVERFLOW", SQLITE_PROFILE["SQLITE_MAX_OVERFLOW"])),
+    }
+
+
+def record_race(connection, email, weekly_mileage, distance, time):
+    """Upsert the user by email and insert their race (meters, minutes) on connection
+
+    Returns (user_id, race_id, VDOT, fitness VDOT). A returning athlete
+    keeps their user_id and gets the new weekly_mileage. Three statements,
+    no commit: the caller commits once.
+    """
+
+    users = User.__table__
+    races = Race.__table__
+    upsert = sqlite_insert(users).values(email=email, weekly_mileage=weekly_mileage)
+    upsert = upsert.on_conflict_do_update(index_elements=[users.c.email],
+                                          set_={"weekly_mileage": upsert.excluded.weekly_mileage})
+    user_id = connection.execute(upsert.returning(users.c.user_id)).scalar_one()
+    VDOT = calculator.user_VDOT(distance, "meters", time)
+    race_id = connection.execute(races.insert().values(
+        user_id=user_id, distance=distance, time=time, vdot=VDOT)).inserted_primary_key[0]
+    # core inserts skip point_user_at_new_race
+    fitness = race_added(connection, user_id, race_id, VDOT)
+    return user_id, race_id, VDOT, fitness
+
+
+class BatchWriter(object):
+    """Insert users and races from one thread, many requests per commit
+
+    add_race() queues a user's race and returns a Future of
+    (user_id, race_id, VDOT, fitness VDOT). The writer thread takes everything queued
+    while the previous commit was running and writes it in one transaction,
+    so under a burst of signups there is one commit, and one wait on the
+    write lock, for many requests. A signup that can't be written fails
+    alone, see write(). Signups are written with record_race().
+    """
+
+    def __init__(self, engine, max_batch=256):
+        self.engine = engine
+        self.max_batch = max_batch
+        self.queue = queue.Queue()
+        self.thread = None
+        self.lock = threading.Lock()
+
+    def add_race(self, email, weekly_mileage, distance, time):
+        """Queue a race (meters, minutes) for the user with email, return a Future"""
+
+        future = Future()
+        self.queue.put((future, email, weekly_mileage, distance, time))
+        self.start()
+        return future
+
+    def start(self):
+        with self.lock:
+            if self.thread is None:
+                self.thread = threading.Thread(target=self.run, name="batch-writer", daemon=True)
+                self.thread.start()
+
+    def close(self):
+        """Write what's queued and stop the thread"""
+
+        with self.lock:
+            if self.thread is not None:
+                self.queue.put(None)
+                self.thread.join()
+                self.thread = None
+
+    def run(self):
+        while True:
+            batch = [self.queue.get()]
+            while len(batch) < self.max_batch:
+                try:
+                    batch.append(self.queue.get_nowait())
+                except queue.Empty:
+                    break
+            stop = None in batch
+            self.write([signup for signup in batch if signup is not None])
+            if stop:
+                return
+
+    def write(self, batch):
+        """Insert batch in one transaction and resolve its futures
+
+        if the transaction fails each signup is retried in its own, so only
+        the bad one fails
+
+        >>> from sqlalchemy import create_engine
+        >>> engine = create_engine("sqlite://")
+        >>> db.metadata.create_all(engine)
+        >>> writer = BatchWriter(engine)
+        >>> signups = [(Future(), "a@example.com", 50, 10000, 42.5), (Future(), "b@example.com", 40, None, 42.5),
+        ...            (Future(), "a@example.com", 55, 5000, 20)]
+        >>> writer.write(signups)
+        >>> [future.exception() is None for future, *race in signups]
+        [True, False, True]
+        >>> [future.result()[:2] for future in (signups[0][0], signups[2][0])]
+        [(1, 1), (1, 2)]
+        >>> with engine.connect() as connection:
+        ...     connection.execute(text("SELECT count(*), max(race_id) FROM races")).one()
+        (2, 2)
+        """
+
+        try:
+            results = self.insert(batch)
+        except Exception as error:
+            if len(batch) == 1:
+                batch[0][0].set_exception(error)
+                return
+            for signup in batch:
+                self.write([signup])
+            return
+        for signup, result in zip(batch, results):
+            signup[0].set_result(result)
+
+    def insert(self, batch):
+        """Return record_race() for each signup in batch, inserted in one transaction"""
+
+        with self.engine.begin() as connection:
+            return [record_race(connection, *signup[1:]) for signup in batch]
+
+
+def connect_to_db(app, db_uri=None):
+    """Connect to the database.
+
+    The uri is db_uri, else app.config["SQLALCHEMY_DATABASE_URI"], else
+    DB_URI. Nothing is sent to the database here unless app.config["DB_SETUP"]
+    (default True) asks for init_db(); workers that shouldn't each run DDL
+    on start set it False and rely on manage.py init-db.
+    """
+    if db_uri is not None:
+        app.config['SQLALCHEMY_DATABASE_URI'] = db_uri
+    db_uri = app.config.setdefault('SQLALCHEMY_DATABASE_URI', DB_URI)
+    app.config.setdefault("DB_SETUP", True)
+    if db_uri.startswith("sqlite") and ":memory:" not in db_uri:
+        app.config.setdefault("SQLALCHEMY_ENGINE_OPTIONS", sqlite_engine_options(app.config))
+    db.init_app(app)
+    with app.app_context():
+        if db_uri.startswith("sqlite"):
+            apply_sqlite_profile(db.engine, app.config)
+        if app.config["DB_SETUP"]:
+            init_db()
+    PLAN_CACHE.resize(app.config.get("PLAN_CACHE_SIZE", PLAN_CACHE.maxsize))
+    PLAN_CACHE.precision = app.config.get("PLAN_CACHE_PRECISION", PLAN_CACHE.precision)
@@ -0,0 +1,57 @@
+"""Precomputed pace zones for the realistic range of VDOT values
+
+Velocities for every intensity in Pace.PACE_DICT are evaluated once, with
+NumPy, over a fine grid of VDOT values. A lookup is then two array reads and
+a linear interpolation instead of three scalar polynomial evaluations.
+
+Error bound: velocity is a quadratic in VDOT for a fixed VDOT percentage p,
+    v(VDOT) = 29.54 + 5.000663 * p * VDOT - 0.007546 * (p * VDOT)**2
+so linear interpolation over a grid step h is off by at most
+    h**2 / 8 * 2 * 0.007546 * p**2
+With h = 0.1 and the largest percentage in PACE_DICT (0.89) that is under
+1.5e-5 meters/minute, or less than 0.001 seconds/mile of pace anywhere in
+the table. VDOTs outside the table fall back to the exact formula.
+"""
+
+import numpy as np
+import calculator
+
+
+VDOT_MIN = 30.0
+VDOT_MAX = 85.0
+VDOT_STEP = 0.1
+
+
+class PaceTable(object):
+    """Velocities in meters/minute (low, avg, high) by VDOT and intensity"""
+
+    def __init__(self, pace_dict, low=VDOT_MIN, high=VDOT_MAX, step=VDOT_STEP):
+        self.low = low
+        self.high = high
+        self.step = step
+        self.intensity_index = dict((intensity, i) for i, intensity in enumerate(pace_dict))
+        self.percents = np.array([pace_dict[intensity] for intensity in pace_dict])
+        size = int(round((high - low) / step)) + 1
+        self.VDOTs = low + step * np.arange(size)
+        # shape: (VDOT, intensity, low/avg/high)
+        percent_VDOT = self.VDOTs[:, np.newaxis, np.newaxis] * self.percents
+        self.velocities = calculator.get_velocity_from_VO2(percent_VDOT)
+
+    def velocity(self, VDOT, intensity):
+        """Return array of velocity (low, avg, high) in meters/minute
+
+        >>> table = PaceTable({"tempo": (0.83, 0.86, 0.89)})
+        >>> exact = calculator.get_velocity_from_VO2(55.55 * 0.86)
+        >>> bool(abs(table.velocity(55.55, "tempo")[1] - exact) < 1.5e-5)
+        True
+
+        """
+        k = self.intensity_index[intensity]
+        position = (VDOT - self.low) / self.step
+        i = int(position)
+        if position < 0 or i >= len(self.VDOTs) - 1:
+            return calculator.get_velocity_from_VO2(VDOT * self.percents[k])
+        fraction = position - i
+        below = self.velocities[i, k]
+        above = self.velocities[i + 1, k]
+        return below + fraction * (above - below)
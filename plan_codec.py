@@ -0,0 +1,367 @@
+"""Compact binary encoding of TrainingPlans, stored one row per user in the plans table
+
+    data = plan_codec.encode(training_plan)
+    training_plan = plan_codec.decode(data)
+
+An encoded plan is a header, its strings and PlanContexts, then three
+tables of fixed-width little-endian records: every week, every workout,
+every segment, in plan order. A week record says how many workout records
+are its own, a workout record how many segment records. Decoding is
+struct.iter_unpack() over a week's records and setting slots, one week at
+a time as the weeks are asked for, see DecodedPlan; the plan template is
+never evaluated again and the plan renders, serializes and exports like
+the plan it was encoded from.
+
+Decoding does build the Week, Workout and Segment objects the pages and
+serializers read, so decoding every week costs most of what building the
+plan from its template does (see the plan.decode and plan.build
+benchmarks). What a stored plan saves is re-planning on every view, and
+a page only decodes the weeks it shows.
+
+Times are stored as whole seconds, so minutes come back as ints when they
+are whole; absent distances are stored as NaN, absent times as 0.
+
+Changing the layout means bumping VERSION. decode() refuses any other
+version, and plan_data() replaces a stored plan of another version with
+a freshly built one.
+"""
+
+from datetime import date
+import math
+import struct
+
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+
+import calculator
+from model import PlanContext, Segment, StoredPlan, TrainingPlan, User, Week, Workout
+
+
+MAGIC = b"FAYC"
+
+VERSION = 1
+
+# magic, version, start date ordinal, weeks, workouts, segments, contexts,
+# intensities, bytes of template name
+HEADER = struct.Struct("<4sBIHHHBBB")
+
+# stop_week, VDOT, weekly_mileage: the plan's history, then its own context
+CONTEXT = struct.Struct("<Hdd")
+
+# percent_peak_mileage, week_in_meters, quality_distance, distance,
+# context, days, quality_days, workouts, segments
+WEEK = struct.Struct("<ddddBBBBH")
+
+# distance, segments
+WORKOUT = struct.Struct("<dB")
+
+# intensity, rep, time and rest in seconds, distance_as_percent, distance
+SEGMENT = struct.Struct("<BHIIdd")
+
+
+def encode(training_plan):
+    """Return bytes of training_plan, building any weeks not built yet
+
+    decode() gives back a plan that serializes the same, re-planned or not
+
+    >>> training_plan = TrainingPlan(PlanContext(48.5, 50), date(2016, 3, 7))
+    >>> decode(encode(training_plan)).as_dict() == training_plan.as_dict()
+    True
+    >>> replanned = training_plan.replan(PlanContext(52.3, 42.5), 6)
+    >>> decoded = decode(encode(replanned))
+    >>> decoded.as_dict() == replanned.as_dict(), decoded.summary()["history"]
+    (True, [{'until_week': 6, 'VDOT': 48.5, 'weekly_mileage': 50}])
+    >>> decode(encode(training_plan)[:-1])
+    Traceback (most recent call last):
+    ...
+    ValueError: encoded plan is 5124 bytes, its header says 5125
+    """
+
+    weeks = training_plan.weeks
+    workouts = [workout for week in weeks for workout in week.workouts]
+    segments = [segment for workout in workouts for segment in workout.segments]
+    contexts = [context for stop_week, context in training_plan.history] + [training_plan.context]
+    stops = [stop_week for stop_week, context in training_plan.history] + [len(weeks)]
+    intensities = sorted(set(segment.intensity for segment in segments))
+    intensity_index = dict((intensity, i) for i, intensity in enumerate(intensities))
+    template = training_plan.template_name.encode("utf-8")
+
+    chunks = [HEADER.pack(MAGIC, VERSION, training_plan.start_date.toordinal(), len(weeks),
+                          len(workouts), len(segments), len(contexts), len(intensities), len(template)),
+              template]
+    for intensity in intensities:
+        name = intensity.encode("utf-8")
+        chunks.append(struct.pack("<B", len(name)) + name)
+    for stop_week, context in zip(stops, contexts):
+        chunks.append(CONTEXT.pack(stop_week, context.VDOT, context.weekly_mileage))
+    for i, week in enumerate(weeks):
+        chunks.append(WEEK.pack(week.percent_peak_mileage, week.week_in_meters, week.quality_distance,
+                                week.distance, context_index(stops, i), week.days, week.quality_days,
+                                len(week.workouts), sum(len(workout.segments) for workout in week.workouts)))
+    for workout in workouts:
+        chunks.append(WORKOUT.pack(workout.distance, len(workout.segments)))
+    for segment in segments:
+        chunks.append(SEGMENT.pack(intensity_index[segment.intensity], segment.rep,
+                                   seconds(segment.time), seconds(segment.rest),
+                                   optional(segment.distance_as_percent), optional(segment.distance)))
+    return b"".join(chunks)
+
+
+def decode(data):
+    """Return the TrainingPlan encoded in data, raise ValueError if it isn't one of this VERSION"""
+
+    return DecodedPlan(data)
+
+
+class DecodedPlan(TrainingPlan):
+    """A TrainingPlan read from encode()'s bytes
+
+    Decoding the header and week table is all __init__ does; a week's
+    workout and segment records are decoded the first time the week is
+    asked for, the way TrainingPlan builds its weeks, so serving two weeks
+    of a stored plan decodes two weeks.
+
+    Everything comes from the bytes: a plan stored before its template in
+    plans/ was edited, or removed, decodes as it was stored. Its template
+    is None, so it can't be replan()ned; re-plan from the User.
+    """
+
+    def __init__(self, data):
+        (magic, version, start_date, week_count, workout_count, segment_count, context_count,
+         intensity_count, template_length) = header(data)
+        view = memoryview(data)
+        offset = HEADER.size
+        template = bytes(view[offset:offset + template_length]).decode("utf-8")
+        offset += template_length
+        self.intensities = []
+        for i in range(intensity_count):
+            length = view[offset]
+            self.intensities.append(bytes(view[offset + 1:offset + 1 + length]).decode("utf-8"))
+            offset += 1 + length
+        size = offset + (CONTEXT.size * context_count + WEEK.size * week_count +
+                         WORKOUT.size * workout_count + SEGMENT.size * segment_count)
+        if len(view) != size:
+            raise ValueError("encoded plan is {} bytes, its header says {}".format(len(view), size))
+        history = tuple((stop_week, PlanContext(VDOT, number(weekly_mileage)))
+                        for stop_week, VDOT, weekly_mileage
+                        in CONTEXT.iter_unpack(view[offset:offset + CONTEXT.size * context_count]))
+        offset += CONTEXT.size * context_count
+        # TrainingPlan.__init__ would look the template up, the bytes have all it gives
+        self.context = history[-1][1]
+        self.history = history[:-1]
+        self.template = None
+        self.template_name = template
+        self.start_date = date.fromordinal(start_date)
+        self._weeks = [None] * week_count
+        self.days = self.make_list_of_days()
+        self.contexts = [context for stop_week, context in history]
+
+        self.week_records = list(WEEK.iter_unpack(view[offset:offset + WEEK.size * week_count]))
+        offset += WEEK.size * week_count
+        self.workout_records = view[offset:offset + WORKOUT.size * workout_count]
+        offset += WORKOUT.size * workout_count
+        self.segment_records = view[offset:offset + SEGMENT.size * segment_count]
+        # index of each week's first workout and first segment record
+        self.first_records = []
+        first_workout = first_segment = 0
+        for record in self.week_records:
+            self.first_records.append((first_workout, first_segment))
+            first_workout += record[7]
+            first_segment += record[8]
+
+    def build_week(self, index):
+        """Return Week number index (from 0) decoded from its records"""
+
+        (percent_peak_mileage, week_in_meters, quality_distance, distance, context_at,
+         days, quality_days, workout_count, segment_count) = self.week_records[index]
+        first_workout, first_segment = self.first_records[index]
+        context = self.contexts[context_at]
+        paces = [context.paces(intensity) for intensity in self.intensities]
+        workouts = WORKOUT.iter_unpack(
+            self.workout_records[WORKOUT.size * first_workout:WORKOUT.size * (first_workout + workout_count)])
+        segments = SEGMENT.iter_unpack(
+            self.segment_records[SEGMENT.size * first_segment:SEGMENT.size * (first_segment + segment_count)])
+
+        week = object.__new__(Week)
+        week.user = context
+        week.percent_peak_mileage = percent_peak_mileage
+        week.peakmileage = calculator.miles_to_meters(context.weekly_mileage)
+        week.week_in_meters = week_in_meters
+        week.plan = self
+        week.days = days
+        week.quality_days = quality_days
+        week.quality_distance = quality_distance
+        week.distance = distance
+        week.workouts = tuple(decode_workout(record, segments, week, context, self.intensities, paces)
+                              for record in workouts)
+        return week
+
+
+def decode_workout(record, segments, week, context, intensities, paces):
+    """Return the Workout for a workout record, taking its segments from the segments iterator"""
+
+    distance, segment_count = record
+    workout = object.__new__(Workout)
+    workout.week = week
+    # a rest day's distance is sum(()), the int 0, see Workout()
+    workout.distance = distance if segment_count else 0
+    workout.segments = tuple(decode_segment(next(segments), workout, context, intensities, paces)
+                             for i in range(segment_count))
+    return workout
+
+
+def decode_segment(record, workout, context, intensities, paces):
+    """Return the Segment for a segment record"""
+
+    intensity, rep, time, rest, distance_as_percent, distance = record
+    segment = object.__new__(Segment)
+    segment.intensity = intensities[intensity]
+    segment.user = context
+    segment.pace = paces[intensity]
+    segment.rep = rep
+    segment.time = minutes(time)
+    segment.total_time = segment.time * rep if segment.time else None
+    segment.rest = minutes(rest)
+    segment.workout = workout
+    segment.distance_as_percent = None if math.isnan(distance_as_percent) else distance_as_percent
+    segment.distance = None if math.isnan(distance) else distance
+    return segment
+
+
+def header(data):
+    """Return the unpacked HEADER of data, raise ValueError if it isn't a plan of this VERSION"""
+
+    if len(data) < HEADER.size or data[:4] != MAGIC:
+        raise ValueError("not an encoded training plan")
+    fields = HEADER.unpack_from(data)
+    if fields[1] != VERSION:
+        raise ValueError("training plan encoding version {}, expected {}".format(fields[1], VERSION))
+    return fields
+
+
+def start_and_weeks(data):
+    """Return (start date, number of weeks) of an encoded plan without decoding it"""
+
+    fields = header(data)
+    return date.fromordinal(fields[2]), fields[3]
+
+
+def context_index(stops, week):
+    """Return the index of the context week number week (from 0) was planned with
+
+    >>> context_index([3, 6, 18], 4)
+    1
+
+    """
+    for i, stop_week in enumerate(stops):
+        if week < stop_week:
+            return i
+    return len(stops) - 1
+
+
+def seconds(minutes):
+    """Return whole seconds for minutes, 0 for None
+
+    >>> seconds(1.5), seconds(None)
+    (90, 0)
+
+    """
+    return int(round(minutes * 60)) if minutes else 0
+
+
+def minutes(seconds):
+    """Return minutes for seconds, an int when whole, None for 0
+
+    >>> minutes(360), minutes(90), minutes(0)
+    (6, 1.5, None)
+
+    """
+    if not seconds:
+        return None
+    return number(seconds / 60.0)
+
+
+def number(value):
+    """Return value as an int when it is whole
+
+    >>> number(50.0), number(52.5)
+    (50, 52.5)
+
+    """
+    return int(value) if value.is_integer() else value
+
+
+def optional(value):
+    """Return value as a float, NaN for None"""
+
+    return float("nan") if value is None else value
+
+
+################################################################################
+# Storage
+
+
+def save(connection, user_id, training_plan):
+    """Encode training_plan as user_id's stored plan on connection and return the bytes
+
+    one upsert, no commit
+    """
+
+    return store(connection, user_id, encode(training_plan))
+
+
+def store(connection, user_id, data):
+    """Upsert data, from encode(), as user_id's stored plan on connection and return it, no commit"""
+
+    plans = StoredPlan.__table__
+    upsert = sqlite_insert(plans).values(user_id=user_id, version=VERSION, data=data)
+    upsert = upsert.on_conflict_do_update(index_elements=[plans.c.user_id],
+                                          set_={"version": VERSION, "data": data})
+    connection.execute(upsert)
+    return data
+
+
+def forget(connection, user_ids):
+    """Delete the stored plans of user_ids on connection, no commit
+
+    for writes that change a user's race or mileage without re-planning;
+    plan_data() rebuilds the plan on its next read
+    """
+
+    plans = StoredPlan.__table__
+    user_ids = list(user_ids)
+    # stay under SQLite's bound parameter limit
+    for i in range(0, len(user_ids), 500):
+        connection.execute(plans.delete().where(plans.c.user_id.in_(user_ids[i:i + 500])))
+
+
+def stored_data(session, user_id):
+    """Return the encoded plan stored for user_id, None when there is none of this VERSION
+
+    one single-row read; a row whose header doesn't read is treated like
+    one of another version, and rebuilt by plan_data()
+    """
+
+    plans = StoredPlan.__table__
+    row = session.execute(plans.select().with_only_columns(plans.c.version, plans.c.data)
+                          .where(plans.c.user_id == user_id)).first()
+    if row is None or row.version != VERSION:
+        return None
+    try:
+        header(row.data)
+    except ValueError:
+        return None
+    return row.data
+
+
+def plan_data(session, user_id):
+    """Return the encoded plan of user_id, from one single-row read when it is stored
+
+    a user without a stored plan of this VERSION gets one from
+    User.replan(), saved on session for the caller to commit
+    """
+
+    data = stored_data(session, user_id)
+    if data is not None:
+        return data
+    user = session.get(User, user_id)
+    return save(session.connection(), user_id, user.replan())
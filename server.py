@@ -1,23 +1,71 @@
 """Training generator"""
 
-from jinja2 import StrictUndefined
+from jinja2 import StrictUndefined, meta
 
-from flask import Flask, render_template, redirect, request, flash, session
-from flask_debugtoolbar import DebugToolbarExtension
+from flask import Blueprint, Flask, current_app, render_template, redirect, request, flash, session, make_response, url_for
 from datetime import timedelta, datetime
+from concurrent.futures import ProcessPoolExecutor
+import atexit
+import hashlib
+import json
+import math
+import multiprocessing
+import time
+import cache
 import calculator
-from model import connect_to_db, db, User, Race, Pace
+import ical
+import jobs
+import metrics
+import plan_codec
+from model import connect_to_db, db, User, Pace, PlanContext, PLAN_CACHE, build_plan_json, week_range
+from model import BatchWriter, record_race
+from jobs import JobQueue
 
-app = Flask(__name__)
+# every page, registered on the app by create_app()
+views = Blueprint("views", __name__)
 
-#required for Flask session and the debug toolbar
-app.secret_key = "ABC"
+# rendered training-plan.html bodies keyed by their ETag
+RENDERED_PLANS = cache.LRUCache(maxsize=256)
 
-# so undefined variable in Jinga2 doesn't fail silently
-# app.jinja_env.undefined = StrictUndefined
+# hash of each template's source, so a changed template changes the ETag
+TEMPLATE_FINGERPRINTS = {}
 
+# app.config defaults, see create_app()
+DEFAULT_CONFIG = {
+    # /bulk-plans builds in a process pool once this many distinct plans are missing
+    "BULK_PROCESS_THRESHOLD": 64,
+    "BULK_PROCESS_WORKERS": None,
+    "BULK_MAX_ATHLETES": 5000,
+    # /calculate-VDOT queues its inserts on one writer thread that group commits
+    "BATCH_WRITES": False,
+    "BATCH_WRITER_MAX": 256,
+    # plans are generated by background jobs instead of in the request, see jobs.py
+    "PLAN_JOBS": False,
+    "JOB_WORKERS": 2,
+    # how often idle workers look for jobs queued by other processes
+    "JOB_POLL_SECONDS": 1.0,
+    # a job running this long lost its worker and is queued again
+    "JOB_LEASE_SECONDS": 300,
+    "JOB_RETENTION_SECONDS": 86400,
+    # longest /jobs/<job_id>?wait= long-poll
+    "JOB_MAX_WAIT": 30,
+    # after a failed plan job the calendar shows its error this long before queueing another
+    "JOB_RETRY_SECONDS": 60,
+}
 
-@app.route("/")
+# created on first use by bulk_plan_pool()
+BULK_POOL = None
+
+# json text of whole plans keyed like PLAN_CACHE, for /bulk-plans
+PLAN_JSON = cache.LRUCache(maxsize=1024)
+
+# cache stats at /metrics
+metrics.register_cache("plans", PLAN_CACHE)
+metrics.register_cache("rendered_plans", RENDERED_PLANS)
+metrics.register_cache("plan_json", PLAN_JSON)
+
+
+@views.route("/")
 def index():
     """Homepage."""
 
@@ -25,7 +73,7 @@ def index():
 
  # return render_template("home.html", blah=blah)
 
-@app.route("/calculate-VDOT", methods=["POST"])
+@views.route("/calculate-VDOT", methods=["POST"])
 def create_table():
     hr = request.form.get("hours")
     mm = request.form.get("minutes")
@@ -45,57 +93,490 @@ def create_table():
 
     distance_in_meters = calculator.convert_distance_to_meters(distance, units)
 
-    new_user = User(email=email, weekly_mileage=peak_mileage)
-    db.session.add(new_user)
+    # returning athletes are matched on email, one transaction and one commit;
+    # their plan is re-planned from the coming week and stored, see User.replan()
+    if current_app.config["BATCH_WRITES"]:
+        signup = batch_writer().add_race(email, peak_mileage, distance_in_meters, time).result()
+    else:
+        signup = record_race(db.session.connection(), email, peak_mileage, distance_in_meters, time)
+    user_id, race_id, race_VDOT, VDOT = signup
+    job_id = None
+    if current_app.config["PLAN_JOBS"]:
+        job_id = jobs.enqueue(db.session.connection(), "plan", user_id)
+    else:
+        plan_codec.save(db.session.connection(), user_id, db.session.get(User, user_id).replan())
     db.session.commit()
-
-    user_obj = User.query.filter(User.email == email).first()
-    user_id = user_obj.user_id
+    if job_id is not None:
+        session["plan_job"] = job_id
+        job_queue().wake()
     session["user_id"] = user_id
+    session["VDOT"] = VDOT
 
-    new_race = Race(user_id=session["user_id"], distance=distance_in_meters, time=time)
-    db.session.add(new_race)
-    db.session.commit()
-
-    session["VDOT"] = new_race.VDOT()
-    easy_pace = user_obj.paces("easy")
-    marathon_pace = user_obj.paces("marathon")
-    tempo_pace = user_obj.paces("tempo")
-
-    easy_list = easy_pace.convert_timedelta()
-    marathon_list = marathon_pace.convert_timedelta()
-    tempo_list = tempo_pace.convert_timedelta()
+    # paces come straight from the fitness VDOT the insert returned, no re-query
+    easy_list = Pace(VDOT, "easy").convert_timedelta()
+    marathon_list = Pace(VDOT, "marathon").convert_timedelta()
+    tempo_list = Pace(VDOT, "tempo").convert_timedelta()
 
     return render_template("generate-calendar.html", VDOT=session["VDOT"],
                            easy_low=easy_list[0], marathon_low=marathon_list[0], tempo_low=tempo_list[0],
                            easy_high=easy_list[2], marathon_high=marathon_list[2], tempo_high=tempo_list[2])
 
 
-@app.route("/generate-calendar")
+@views.route("/generate-calendar")
 def create_calendar():
+    """Render weeks of the user's training plan, or 304 if the client has them already
+
+    ?week=3 shows one week, ?weeks=3-5 a range and ?weeks=all the whole
+    plan (weeks count from 1). Without either, the current and next week
+    are shown, and only the weeks shown are built.
+
+    The plan is the user's stored one, a single row read, see
+    plan_codec.plan_data(); only the weeks shown are decoded. The body is
+    cached under a hash of the stored plan and week range, which doubles
+    as a strong ETag, so an unchanged page is neither decoded nor
+    re-rendered.
+    """
     # TODO(kara, login): change this to call off the user_id when you have login conf.
 
-    user = db.session.query(User).filter(User.user_id == session["user_id"]).first()
-    training_plan = user.training_plan()
-    weeks = training_plan.weeks
-    days_list = training_plan.days
-    zipped_training_plan = []
-    for week in weeks:
-        workouts = week.workouts
-        zipped_training_plan.append(list(zip(days_list, workouts)))
-        days_list = days_list[7:]
+    data, pending = stored_plan(session["user_id"])
+    if data is None:
+        return pending
+    start_date, total_weeks = plan_codec.start_and_weeks(data)
+    try:
+        first, last = week_range(request.args, total_weeks, start_date)
+    except ValueError as error:
+        return str(error), 400
+    etag = plan_etag("training-plan.html", (hashlib.sha256(data).hexdigest(), first, last))
 
-    return render_template("training-plan.html", training_plan=weeks,
-                           zipped_training_plan=zipped_training_plan)
+    if etag in request.if_none_match:
+        response = current_app.response_class(status=304)
+    else:
+        body = RENDERED_PLANS.get_or_build(etag, lambda: render_plan(plan_codec.decode(data), first, last))
+        response = make_response(body)
+    response.set_etag(etag)
+    # per-user content, let the browser keep it but always revalidate
+    response.cache_control.private = True
+    response.cache_control.no_cache = True
+    return response
 
 
-if __name__ == "__main__":
-    #must set to true befor invoking DebugToolbarExtension
-    app.debug = True
+def render_plan(training_plan, first, last):
+    """Return training-plan.html for weeks first to last (from 0, last exclusive)"""
+
+    return render_template("training-plan.html", training_plan=training_plan[first:last],
+                           zipped_training_plan=training_plan.calendar(first, last),
+                           first_week=first + 1, last_week=last, total_weeks=len(training_plan))
+
+
+@views.route("/replan", methods=["POST"])
+def replan():
+    """Re-plan the user's training plan from the coming week, then show the calendar
+
+    takes an optional new weekly mileage ("mileage"); a new race goes
+    through /calculate-VDOT, which re-plans too. Weeks already started
+    are kept, see User.replan(). With PLAN_JOBS the re-plan is a job and
+    the calendar answers 202 until it is done.
+    """
+
+    user = db.session.get(User, session["user_id"])
+    mileage = request.form.get("mileage")
+    if mileage is not None:
+        try:
+            mileage = float(mileage)
+        except ValueError:
+            return "mileage must be a number", 400
+        if not (math.isfinite(mileage) and mileage > 0):
+            return "mileage must be a positive number", 400
+        user.weekly_mileage = mileage
+    if current_app.config["PLAN_JOBS"]:
+        session["plan_job"] = jobs.enqueue(db.session.connection(), "plan", user.user_id)
+        db.session.commit()
+        job_queue().wake()
+    else:
+        plan_codec.save(db.session.connection(), user.user_id, user.replan())
+        db.session.commit()
+    return redirect("/generate-calendar")
+
+
+@views.route("/plan-jobs", methods=["POST"])
+def enqueue_plan():
+    """Queue re-planning and storing the user's training plan, answer 202 with the job at once
+
+    poll the job at its status_url, see job_status()
+    """
+
+    job_id = jobs.enqueue(db.session.connection(), "plan", session["user_id"])
+    db.session.commit()
+    session["plan_job"] = job_id
+    job_queue().wake()
+    return job_response(jobs.status(db.session, job_id))
+
+
+@views.route("/jobs/<int:job_id>")
+def job_status(job_id):
+    """Return one of the user's jobs as json
+
+    ?wait=seconds long-polls: the answer comes as soon as the job is done
+    or failed, or after the wait (at most JOB_MAX_WAIT) with it unfinished
+    """
+
+    try:
+        wait = min(float(request.args.get("wait", 0)), current_app.config["JOB_MAX_WAIT"])
+    except ValueError:
+        return json_error("wait must be a number of seconds")
+    job = jobs.status(db.session, job_id)
+    if job is None or job["user_id"] != session.get("user_id"):
+        return json_error("no such job", 404)
+    if wait > 0 and job["status"] not in jobs.FINISHED:
+        # nothing of this request's transaction is needed while waiting
+        db.session.commit()
+        job = job_queue().wait(job_id, wait)
+        # deleted while waiting, by maintain() or another process
+        if job is None:
+            return json_error("no such job", 404)
+    return job_response(job, 200)
+
+
+@views.route("/generate-calendar.json")
+def plan_json():
+    """Stream the user's training plan as json, one week at a time
+
+    Raw values only: meters, seconds, meters/minute. Stored plans are
+    decoded lazily, weeks are serialized as they are decoded, so the first
+    bytes go out before the last week exists.
+    """
+
+    data, pending = stored_plan(session["user_id"])
+    if data is None:
+        return pending
+    training_plan = plan_codec.decode(data)
+
+    return current_app.response_class(stream_plan_json(training_plan), mimetype="application/json")
+
+
+@views.route("/training-plan.ics")
+def plan_ics():
+    """Stream the user's training plan as an iCalendar file, one event per workout day"""
+
+    user = db.session.get(User, session["user_id"])
+    data, pending = stored_plan(user.user_id)
+    if data is None:
+        return pending
+    training_plan = plan_codec.decode(data)
+    chunks = ical.iter_calendar([(user.email, training_plan)])
+
+    response = current_app.response_class(chunks, mimetype="text/calendar")
+    response.headers["Content-Disposition"] = "attachment; filename=training-plan.ics"
+    return response
+
+
+def stream_plan_json(training_plan):
+    """Yield a plan as json text, week by week"""
+
+    yield '{"plan": ' + json.dumps(training_plan.summary()) + ', "weeks": ['
+    for i, week in enumerate(training_plan.iter_weeks()):
+        separator = ", " if i else ""
+        yield separator + json.dumps(week.as_dict(training_plan.week_days(i)))
+    yield "]}"
+
+
+@views.route("/bulk-plans", methods=["POST"])
+def bulk_plans():
+    """Return training plans for a squad of athletes in one request
+
+    Takes json {"athletes": [{"distance", "units", "time", "weekly_mileage"}, ...]}
+    with time as minutes or "h:m:s". Athletes whose inputs round to the same
+    plan share it: each distinct plan is built and serialized (or read from
+    PLAN_JSON) once and appears once in "plans", "athletes" points into
+    that list. Large batches build and serialize in a process pool.
+    """
+
+    athletes = (request.get_json(silent=True) or {}).get("athletes")
+    if not isinstance(athletes, list) or not athletes:
+        return json_error("expected a non-empty list of athletes")
+    if len(athletes) > current_app.config["BULK_MAX_ATHLETES"]:
+        return json_error("at most {} athletes per request".format(current_app.config["BULK_MAX_ATHLETES"]))
+
+    parsed = []
+    for i, athlete in enumerate(athletes):
+        try:
+            parsed.append(parse_athlete(athlete))
+        except (AttributeError, KeyError, TypeError, ValueError) as error:
+            return json_error("bad athlete {}: {}".format(i, error))
+    distances, units, times, mileages = [list(column) for column in zip(*parsed)]
+
+    VDOTs = calculator.user_VDOT_array(distances, units, times)
+    for i, VDOT in enumerate(VDOTs):
+        if not calculator.plausible_VDOT(VDOT):
+            return json_error("bad athlete {}: VDOT must be between {:g} and {:g}".format(
+                i, *calculator.VDOT_LIMITS))
+    keys = [PLAN_CACHE.key(PlanContext(round(float(VDOT), PLAN_CACHE.precision), mileage))
+            for VDOT, mileage in zip(VDOTs, mileages)]
+
+    missing = set(key for key in keys if key not in PLAN_JSON)
+    executor = None
+    if len(missing) >= current_app.config["BULK_PROCESS_THRESHOLD"]:
+        executor = bulk_plan_pool()
+    plans = PLAN_JSON.get_or_build_many(keys, build_plan_json, executor)
+
+    plan_index = {}
+    plan_list = []
+    results = []
+    for VDOT, key in zip(VDOTs, keys):
+        if key not in plan_index:
+            plan_index[key] = len(plan_list)
+            plan_list.append(plans[key])
+        results.append({"VDOT": float(VDOT), "plan": plan_index[key]})
+
+    body = '{"plans": [' + ", ".join(plan_list) + '], "athletes": ' + json.dumps(results) + "}"
+    return body, 200, {"Content-Type": "application/json"}
+
+
+@views.route("/equivalent-times.json", methods=["GET", "POST"])
+def equivalent_times():
+    """Return the race times one or many VDOTs predict over a set of distances
+
+    GET ?VDOT=48.5&VDOT=52 or POST json {"VDOTs": [...]}; with neither, the
+    session's VDOT. distance (repeated, or "distances" in json) in meters
+    replaces calculator.RACE_DISTANCES. Times are whole seconds, null where
+    a VDOT can't be run over a distance. Every time is solved in one
+    vectorized call, see calculator.race_time_array.
+    """
+
+    if request.method == "POST":
+        body = request.get_json(silent=True) or {}
+        VDOTs = body.get("VDOTs")
+        distances = body.get("distances")
+    else:
+        VDOTs = request.args.getlist("VDOT") or None
+        distances = request.args.getlist("distance") or None
+    if VDOTs is None and "VDOT" in session:
+        VDOTs = [session["VDOT"]]
+    if not isinstance(VDOTs, list) or not VDOTs:
+        return json_error("expected one or more VDOTs")
+    if len(VDOTs) > current_app.config["BULK_MAX_ATHLETES"]:
+        return json_error("at most {} VDOTs per request".format(current_app.config["BULK_MAX_ATHLETES"]))
+
+    if distances is not None and not isinstance(distances, list):
+        return json_error("expected a list of distances")
+
+    try:
+        VDOTs = [float(VDOT) for VDOT in VDOTs]
+        if distances is None:
+            names = [name for name, meters in calculator.RACE_DISTANCES]
+            distances = [meters for name, meters in calculator.RACE_DISTANCES]
+        else:
+            distances = [float(meters) for meters in distances]
+            names = ["{:g}m".format(meters) for meters in distances]
+    except (TypeError, ValueError) as error:
+        return json_error("bad VDOT or distance: {}".format(error))
+    if not all(calculator.plausible_VDOT(VDOT) for VDOT in VDOTs):
+        return json_error("VDOTs must be between {:g} and {:g}".format(*calculator.VDOT_LIMITS))
+    if not distances or not all(math.isfinite(meters) and meters > 0 for meters in distances):
+        return json_error("distances must be positive numbers")
+
+    seconds = (calculator.equivalent_times(VDOTs, distances) * 60).round()
+    # a VDOT too far off the formulas' range gives no finite time, like one that can't be run
+    rows = [[int(value) if math.isfinite(value) else None for value in row] for row in seconds.tolist()]
+    result = {
+        "distances": [{"name": name, "meters": meters} for name, meters in zip(names, distances)],
+        "athletes": [{"VDOT": VDOT, "seconds": row} for VDOT, row in zip(VDOTs, rows)],
+    }
+    return json.dumps(result), 200, {"Content-Type": "application/json"}
+
+
+def parse_athlete(athlete):
+    """Return (distance, units, minutes, weekly_mileage) of a /bulk-plans athlete
+
+    raises ValueError for the inputs manage.parse_record() rejects too, see
+    calculator.check_race()
+    """
+
+    distance = float(athlete["distance"])
+    units = athlete.get("units", "meters")
+    time = race_minutes(athlete["time"])
+    mileage = float(athlete["weekly_mileage"])
+    calculator.check_race(distance, units, time, mileage)
+    return distance, units, time, mileage
+
+
+def race_minutes(race_time):
+    """Return race time in minutes from minutes or an "h:m:s" string"""
+
+    if isinstance(race_time, str):
+        return calculator.hms_to_minutes(race_time)
+    return float(race_time)
+
+
+def bulk_plan_pool():
+    """Return the process pool for /bulk-plans, started on first use and shut down at exit
+
+    workers are spawned, not forked, so they don't inherit the app's
+    database connections, threads and locks
+    """
+
+    global BULK_POOL
+    if BULK_POOL is None:
+        BULK_POOL = ProcessPoolExecutor(max_workers=current_app.config["BULK_PROCESS_WORKERS"],
+                                        mp_context=multiprocessing.get_context("spawn"))
+        atexit.register(BULK_POOL.shutdown)
+    return BULK_POOL
+
+
+def batch_writer():
+    """Return the app's BatchWriter for /calculate-VDOT, started on first use"""
+
+    writer = current_app.extensions.get("batch_writer")
+    if writer is None:
+        writer = BatchWriter(db.engine, max_batch=current_app.config["BATCH_WRITER_MAX"])
+        current_app.extensions["batch_writer"] = writer
+    return writer
+
+
+def job_queue():
+    """Return the app's JobQueue, its workers started on first use"""
+
+    queue = current_app.extensions.get("job_queue")
+    if queue is None:
+        config = current_app.config
+        queue = current_app.extensions.setdefault("job_queue", JobQueue(
+            current_app._get_current_object(), workers=config["JOB_WORKERS"],
+            poll=config["JOB_POLL_SECONDS"], lease=config["JOB_LEASE_SECONDS"],
+            retention=config["JOB_RETENTION_SECONDS"]))
+    return queue
+
+
+def stored_plan(user_id):
+    """Return (encoded plan, None) for user_id, or (None, 202 response) while a job makes it
+
+    without PLAN_JOBS a missing plan is built in the request, see
+    plan_codec.plan_data(). With it, the user's plan job is checked, and a
+    job is queued if there is no stored plan at all. When the user's last
+    plan job failed less than JOB_RETRY_SECONDS ago the answer is that job,
+    with its error, as a 503 with Retry-After instead.
+    """
+
+    if not current_app.config["PLAN_JOBS"]:
+        data = plan_codec.plan_data(db.session, user_id)
+        db.session.commit()
+        return data, None
+    job_id = session.get("plan_job")
+    if job_id is not None:
+        job = jobs.status(db.session, job_id)
+        if job is not None and job["status"] not in jobs.FINISHED:
+            return None, job_response(job)
+        session.pop("plan_job")
+    data = plan_codec.stored_data(db.session, user_id)
+    if data is not None:
+        return data, None
+    retry = current_app.config["JOB_RETRY_SECONDS"]
+    failed = jobs.recent_failure(db.session, "plan", user_id, time.time() - retry)
+    if failed is not None:
+        response = job_response(failed, 503)
+        response.headers["Retry-After"] = str(max(1, math.ceil(failed["finished_at"] + retry - time.time())))
+        return None, response
+    job_id = jobs.enqueue(db.session.connection(), "plan", user_id)
+    db.session.commit()
+    session["plan_job"] = job_id
+    job_queue().wake()
+    return None, job_response(jobs.status(db.session, job_id))
+
+
+def job_response(job, status=202):
+    """Return a job as json, 202 with a Location to poll unless status says otherwise"""
+
+    body = dict(job, status_url=url_for("views.job_status", job_id=job["job_id"]))
+    if job["kind"] == "plan" and job["status"] == "done":
+        body["plan_url"] = url_for("views.create_calendar")
+    response = current_app.response_class(json.dumps(body), status=status, mimetype="application/json")
+    if job["status"] not in jobs.FINISHED:
+        response.headers["Retry-After"] = "1"
+        if status == 202:
+            response.headers["Location"] = body["status_url"]
+    return response
+
+
+def json_error(message, status=400):
+    """Return a json error response"""
+
+    return json.dumps({"error": message}), status, {"Content-Type": "application/json"}
+
+
+def plan_etag(template_name, key):
+    """Return strong ETag for template_name rendered from key, a tuple of plan hash, first and last week"""
+
+    fingerprint = TEMPLATE_FINGERPRINTS.get(template_name)
+    if fingerprint is None:
+        fingerprint = template_fingerprint(template_name)
+        TEMPLATE_FINGERPRINTS[template_name] = fingerprint
+    content = repr((template_name, fingerprint) + tuple(key))
+    return hashlib.sha256(content.encode("utf-8")).hexdigest()
+
+
+def template_fingerprint(template_name):
+    """Return sha256 hex of the source of template_name and every template it extends, includes or imports
+
+    >>> from jinja2 import DictLoader
+    >>> app = create_app({"DB_SETUP": False})
+    >>> app.jinja_loader = DictLoader({"base.html": "<b>{% block body %}{% endblock %}</b>",
+    ...                                "page.html": "{% extends 'base.html' %}"})
+    >>> with app.app_context():
+    ...     before = template_fingerprint("page.html")
+    ...     app.jinja_loader.mapping["base.html"] = "<i>{% block body %}{% endblock %}</i>"
+    ...     before == template_fingerprint("page.html")
+    False
+    """
+
+    env = current_app.jinja_env
+    digest = hashlib.sha256()
+    pending, seen = [template_name], set()
+    while pending:
+        name = pending.pop()
+        if name in seen:
+            continue
+        seen.add(name)
+        source = current_app.jinja_loader.get_source(env, name)[0]
+        digest.update(repr((name, source)).encode("utf-8"))
+        # None for names only known at render time, which can't be followed
+        pending.extend(sorted(referenced for referenced in meta.find_referenced_templates(env.parse(source))
+                              if referenced is not None))
+    return digest.hexdigest()
+
+
+def create_app(config=None):
+    """Return the app, configured from DEFAULT_CONFIG, FLASK_* environment variables, then config
+
+    Importing this module does no work; the database is set up as
+    connect_to_db() describes, and debug-only extensions are only imported
+    when the app is in debug mode.
+    """
+
+    app = Flask(__name__)
+
+    #required for Flask session and the debug toolbar
+    app.secret_key = "ABC"
+
+    # so undefined variable in Jinga2 doesn't fail silently
+    # app.jinja_env.undefined = StrictUndefined
+
+    app.config.update(DEFAULT_CONFIG)
+    app.config.from_prefixed_env()
+    app.config.update(config or {})
 
     connect_to_db(app)
+    app.register_blueprint(views)
+    # latency, SQL, template and plan build metrics at /metrics
+    metrics.init_app(app)
+
+    if app.debug:
+        from flask_debugtoolbar import DebugToolbarExtension
+        DebugToolbarExtension(app)
+
+    return app
 
-    # comment out to turn debug off
-    DebugToolbarExtension(app)
+
+if __name__ == "__main__":
+    #must set to true befor invoking DebugToolbarExtension
+    app = create_app({"DEBUG": True})
 
     app.run()